@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+
+# compare hot path timings with baseline, first run stores the baseline
+baseline=results/benchmark_baseline.json
+
+if [ -f $baseline ]; then
+  python src/benchmark.py --output results/benchmark.json --compare $baseline $*
+else
+  python src/benchmark.py --output $baseline $*
+fi
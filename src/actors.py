@@ -0,0 +1,189 @@
+import multiprocessing
+import Queue
+import mmap
+import copy
+import random
+import time
+import logging
+import numpy as np
+logger = logging.getLogger(__name__)
+from replay_memory import ReplayMemory, PartitionedReplayMemory
+
+def sharedArray(shape, dtype):
+  # anonymous mmap is shared with forked processes and allocated lazily
+  dtype = np.dtype(dtype)
+  nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+  buf = mmap.mmap(-1, nbytes)
+  return np.frombuffer(buf, dtype = dtype, count = int(np.prod(shape))).reshape(shape)
+
+class SharedReplayMemory(ReplayMemory):
+  """
+  Replay memory partition in shared memory. It is created in learner process
+  before actors are forked, one actor process fills it and learner samples
+  from it. All arrays and counters are shared, lock guards them.
+  """
+  def __init__(self, size, args):
+    assert args.replay_storage in ('memory', 'memmap'), "Compressed replay storage can't be shared between processes"
+    # count, current and valid_count
+    self.counters = sharedArray(3, np.int64)
+    ReplayMemory.__init__(self, size, args)
+    self.lock = multiprocessing.Lock()
+
+  def _allocate(self, shape, dtype):
+    return sharedArray(shape, dtype)
+
+  def _getCounter(i):
+    return property(lambda self: int(self.counters[i]), lambda self, value: self.counters.__setitem__(i, value))
+
+  count = _getCounter(0)
+  current = _getCounter(1)
+  valid_count = _getCounter(2)
+  del _getCounter
+
+class ActorPool:
+  """
+  Ape-X style acting with several local processes. Each actor runs its own
+  environment and agent with its own exploration rate and writes transitions
+  to its own shared replay memory partition. Learner in the main process
+  samples from all partitions and periodically publishes network weights.
+  """
+  def __init__(self, args):
+    assert not args.prioritized_replay, "Prioritized replay is not supported with actors"
+    self.num_actors = args.actors
+    self.publish_steps = args.publish_steps
+    self.target_steps = args.target_steps
+    self.batch_size = args.batch_size
+
+    self.partitions = []
+    for i in xrange(self.num_actors):
+      partition_args = copy.copy(args)
+      if args.replay_file:
+        partition_args.replay_file = "%s.%d" % (args.replay_file, i)
+      self.partitions.append(SharedReplayMemory(args.replay_size // self.num_actors, partition_args))
+    self.mem = PartitionedReplayMemory(self.partitions, args)
+
+    # steps, games and sum of game rewards for each actor
+    self.counters = sharedArray((self.num_actors, 3), np.float64)
+    self.stop_event = multiprocessing.Event()
+    # queue size 1, because actors only need the latest weights
+    self.weight_queues = [multiprocessing.Queue(1) for i in xrange(self.num_actors)]
+    self.processes = [multiprocessing.Process(target = _runActor,
+        args = (i, self.partitions[i], self.weight_queues[i], self.counters[i], self.stop_event, args))
+        for i in xrange(self.num_actors)]
+
+  def start(self):
+    # must be called before creating Neon backend in the learner process
+    logger.info("Starting %d actor processes" % self.num_actors)
+    for process in self.processes:
+      process.daemon = True
+      process.start()
+
+  def publish(self, net):
+    pdict = net.model.get_description(get_weights = True, keep_states = False)
+    for queue in self.weight_queues:
+      # replace weights that were not picked up yet
+      try:
+        queue.get_nowait()
+      except Queue.Empty:
+        pass
+      try:
+        queue.put_nowait(pdict)
+      except Queue.Full:
+        pass
+
+  def numSteps(self):
+    return int(self.counters[:, 0].sum())
+
+  def waitForSteps(self, num_steps):
+    # wait until actors have populated replay memory
+    logger.info("Waiting for actors to make %d steps" % num_steps)
+    while self.numSteps() < num_steps:
+      time.sleep(0.1)
+
+  def train(self, agent, train_steps, epoch = 0):
+    # learner trains continuously until actors have made train_steps steps
+    start_counters = self.counters.sum(axis = 0)
+    last_steps = start_steps = int(start_counters[0])
+    next_target = start_steps + self.target_steps
+    num_updates = 0
+    while last_steps - start_steps < train_steps:
+      if self.mem.count > self.batch_size:
+        agent.learn(epoch)
+        num_updates += 1
+        if num_updates % self.publish_steps == 0:
+          self.publish(agent.net)
+      else:
+        time.sleep(0.01)
+      # update target network every target_steps actor steps
+      steps = self.numSteps()
+      if self.target_steps and steps >= next_target:
+        agent.net.update_target_network()
+        next_target = steps + self.target_steps
+      agent.total_train_steps += steps - last_steps
+      last_steps = steps
+    self.publish(agent.net)
+
+    steps, games, rewards = self.counters.sum(axis = 0) - start_counters
+    logger.info("  actors made %d steps, %d games with average reward %f, learner made %d updates" %
+        (steps, games, rewards / max(games, 1), num_updates))
+
+  def stop(self):
+    self.stop_event.set()
+    for process in self.processes:
+      process.join()
+
+def _runActor(index, mem, weight_queue, counters, stop_event, args):
+  # imported here, so that Neon backend is created only in actor process
+  from environment import ALEEnvironment, GymEnvironment, SyntheticEnvironment
+  from deepqnetwork import DeepQNetwork
+  from agent import Agent
+
+  args = copy.copy(args)
+  args.display_screen = False
+  args.record_screen_path = None
+  args.record_sound_filename = None
+  args.backend = args.actor_backend
+  # actors don't train, so they don't need target network
+  args.target_steps = 0
+  args.target_update_tau = 0
+  # forked processes inherit random state, so it must differ for each actor
+  if args.random_seed:
+    args.random_seed += index + 1
+    random.seed(args.random_seed)
+    np.random.seed(args.random_seed)
+  else:
+    random.seed()
+    np.random.seed()
+
+  if args.environment == 'ale':
+    env = ALEEnvironment(args.game, args)
+  elif args.environment == 'gym':
+    env = GymEnvironment(args.game, args)
+  elif args.environment == 'synthetic':
+    env = SyntheticEnvironment(args)
+  else:
+    assert False, "Unknown environment" + args.environment
+  net = DeepQNetwork(env.numActions(), args)
+  agent = Agent(env, mem, net, args)
+
+  # each actor has different fixed exploration rate, like in Ape-X
+  exploration_rate = args.actor_exploration_rate ** (1 + args.actor_exploration_alpha * index / max(args.actors - 1, 1.))
+  logger.info("Actor %d exploration rate: %f" % (index, exploration_rate))
+
+  # wait for initial weights from learner
+  net.model.deserialize(weight_queue.get(), load_states = False)
+  env.setMode('train')
+  agent._restartRandom()
+  game_reward = 0
+  while not stop_event.is_set():
+    try:
+      net.model.deserialize(weight_queue.get_nowait(), load_states = False)
+    except Queue.Empty:
+      pass
+    action, reward, screen, terminal = agent.step(exploration_rate, mem)
+    game_reward += reward
+    counters[0] += 1
+    if terminal:
+      counters[1] += 1
+      counters[2] += game_reward
+      game_reward = 0
@@ -1,8 +1,12 @@
 import random
+import time
 import logging
 import numpy as np
 logger = logging.getLogger(__name__)
 from state_buffer import StateBuffer
+from prefetcher import MinibatchPrefetcher
+from learner import LearnerThread
+from timers import Timers
 
 class Agent:
   def __init__(self, environment, replay_memory, deep_q_network, args):
@@ -10,9 +14,12 @@ class Agent:
     self.mem = replay_memory
     self.net = deep_q_network
     self.buf = StateBuffer(args)
-    self.num_actions = self.env.numActions()
+    self.num_actions = self.net.num_actions
     self.random_starts = args.random_starts
     self.history_length = args.history_length
+    self.device_history = args.device_history
+    # screens in RAM can be shared by replay memory and state buffer
+    self.share_screens = args.replay_storage == 'memory'
 
     self.exploration_rate_start = args.exploration_rate_start
     self.exploration_rate_end = args.exploration_rate_end
@@ -23,11 +30,35 @@ class Agent:
     self.train_frequency = args.train_frequency
     self.train_repeat = args.train_repeat
     self.target_steps = args.target_steps
+    self.prioritized_replay = args.prioritized_replay
+
+    # sample minibatches in background thread or directly from memory
+    if args.prefetch_minibatches:
+      self.prefetcher = MinibatchPrefetcher(self.mem, args)
+      self.sampler = self.prefetcher
+    else:
+      self.prefetcher = None
+      self.sampler = self.mem
+
+    # train in background thread while acting
+    if args.learner_thread:
+      self.learner = LearnerThread(self, args)
+    else:
+      self.learner = None
+
+    # wall-clock time of agent phases, learner thread adds sampling, training, priorities and target_sync
+    self.timers = Timers(['emulation', 'preprocessing', 'prediction', 'state_buffer', 'restart', 'replay', 'sampling', 'training', 'priorities', 'target_sync'])
 
     self.callback = None
 
   def _restartRandom(self):
     self.env.restart()
+    frames = self.env.startFrames()
+    if frames is not None:
+      # dummy actions were already played in background
+      for screen in frames:
+        self._addScreen(screen)
+      return
     # perform random number of dummy actions to produce more stochastic games
     for i in xrange(random.randint(self.history_length, self.random_starts) + 1):
       reward = self.env.act(0)
@@ -35,7 +66,16 @@ class Agent:
       terminal = self.env.isTerminal()
       assert not terminal, "terminal state occurred during random initialization"
       # add dummy states to buffer
+      self._addScreen(screen)
+
+  def _addScreen(self, screen, mem = None):
+    if mem is not None and self.share_screens:
+      # screen was just added to replay memory, state refers to it there
+      self.buf.addShared(mem)
+    else:
       self.buf.add(screen)
+    if self.device_history:
+      self.net.addFrame(screen)
 
   def _explorationRate(self):
     # calculate decaying exploration rate
@@ -44,38 +84,54 @@ class Agent:
     else:
       return self.exploration_rate_end
 
-  def step(self, exploration_rate):
+  def step(self, exploration_rate, mem = None):
+    # transition is added to mem, if given, before the screen is reused
+    start = time.time()
     # exploration rate determines the probability of random moves
     if random.random() < exploration_rate:
       action = random.randrange(self.num_actions)
       logger.debug("Random action = %d" % action)
     else:
       # otherwise choose action with highest Q-value
-      state = self.buf.getStateMinibatch()
-      # for convenience getStateMinibatch() returns minibatch
-      # where first item is the current state
-      qvalues = self.net.predict(state)
+      if self.device_history:
+        # state is already in backend memory
+        qvalues = self.net.predictHistory()
+      else:
+        state = self.buf.getState()
+        # predict Q-values for minibatch of one state
+        qvalues = self.net.predict(state[np.newaxis])
       assert len(qvalues[0]) == self.num_actions
       # choose highest Q-value of first state
       action = np.argmax(qvalues[0])
       logger.debug("Predicted action = %d" % action)
+    start = self.timers.add('prediction', start)
 
     # perform the action
     reward = self.env.act(action)
+    start = self.timers.add('emulation', start)
     screen = self.env.getScreen()
     terminal = self.env.isTerminal()
+    start = self.timers.add('preprocessing', start)
 
     # print reward
     if reward <> 0:
       logger.debug("Reward: %d" % reward)
 
+    # add transition to replay memory
+    if mem is not None:
+      mem.add(action, reward, screen, terminal)
+      start = self.timers.add('replay', start)
+
     # add screen to buffer
-    self.buf.add(screen)
+    self._addScreen(screen, mem)
+    start = self.timers.add('state_buffer', start)
 
-    # restart the game if over
+    # restart the game if over, screen buffer is reused by restart
     if terminal:
       logger.debug("Terminal state, restarting")
+      screen = screen.copy()
       self._restartRandom()
+      self.timers.add('restart', start)
 
     # call callback to record statistics
     if self.callback:
@@ -87,31 +143,76 @@ class Agent:
     # play given number of steps
     for i in xrange(random_steps):
       # use exploration rate 1 = completely random
-      action, reward, screen, terminal = self.step(1)
-      self.mem.add(action, reward, screen, terminal)
+      self.step(1, self.mem)
 
   def train(self, train_steps, epoch = 0):
+    if self.learner:
+      self._trainPipelined(train_steps, epoch)
+      return
     # do not do restart here, continue from testing
     #self._restartRandom()
     # play given number of steps
     for i in xrange(train_steps):
       # perform game step
-      action, reward, screen, terminal = self.step(self._explorationRate())
+      self.step(self._explorationRate(), self.mem)
+      # Update target network every target_steps steps
+      if self.target_steps and i % self.target_steps == 0:
+        start = time.time()
+        self.net.update_target_network()
+        self.timers.add('target_sync', start)
+      # train after every train_frequency steps
+      if self.mem.count > self.mem.batch_size and i % self.train_frequency == 0:
+        self.learn(epoch)
+      # increase number of training steps for epsilon decay
+      self.total_train_steps += 1
+
+  def _trainPipelined(self, train_steps, epoch):
+    # learner thread trains and updates target network, agent only acts
+    self.learner.start(epoch)
+    try:
+      for i in xrange(train_steps):
+        self.step(self._explorationRate(), self.mem)
+        self.total_train_steps += 1
+        self.learner.addStep()
+    finally:
+      self.learner.stop()
+
+  def train_offline(self, transitions, train_steps, epoch = 0):
+    # same as train(), but transitions come from dataset instead of playing
+    for i in xrange(train_steps):
+      action, reward, screen, terminal = next(transitions)
       self.mem.add(action, reward, screen, terminal)
+      # call callback to record statistics of dataset games
+      if self.callback:
+        self.callback.on_step(action, reward, terminal, screen, 0)
       # Update target network every target_steps steps
       if self.target_steps and i % self.target_steps == 0:
         self.net.update_target_network()
       # train after every train_frequency steps
       if self.mem.count > self.mem.batch_size and i % self.train_frequency == 0:
-        # train for train_repeat times
-        for j in xrange(self.train_repeat):
-          # sample minibatch
-          minibatch = self.mem.getMinibatch()
-          # train the network
-          self.net.train(minibatch, epoch)
+        self.learn(epoch)
       # increase number of training steps for epsilon decay
       self.total_train_steps += 1
 
+  def learn(self, epoch = 0):
+    # train for train_repeat times
+    for j in xrange(self.train_repeat):
+      start = time.time()
+      # sample minibatch
+      minibatch = self.sampler.getMinibatch()
+      start = self.timers.add('sampling', start)
+      if self.prioritized_replay:
+        # train the network with importance sampling weights
+        errors = self.net.train(minibatch, epoch, self.sampler.weights)
+        start = self.timers.add('training', start)
+        # update priorities of sampled transitions with new TD errors
+        self.mem.updatePriorities(self.sampler.indexes, errors)
+        self.timers.add('priorities', start)
+      else:
+        # train the network
+        self.net.train(minibatch, epoch)
+        self.timers.add('training', start)
+
   def test(self, test_steps, epoch = 0):
     # just make sure there is history_length screens to form a state
     self._restartRandom()
@@ -127,6 +228,135 @@ class Agent:
       # play until terminal state
       terminal = False
       while not terminal:
-        action, reward, screen, terminal = self.step(self.exploration_rate_test)
         # add experiences to replay memory for visualization
-        self.mem.add(action, reward, screen, terminal)
+        action, reward, screen, terminal = self.step(self.exploration_rate_test, self.mem)
+
+class VectorAgent(Agent):
+  """
+  Acts in several environments in lockstep, so that actions for all of them
+  are predicted with one forward pass. Each environment has its own row in
+  state buffer and its own replay memory partition. Number of steps is
+  counted over all environments and rounded up to multiple of their number.
+  """
+  def __init__(self, environment, replay_memory, deep_q_network, args):
+    Agent.__init__(self, environment, replay_memory, deep_q_network, args)
+    self.envs = environment.envs
+    self.num_envs = len(self.envs)
+    assert self.num_envs <= self.buf.batch_size, "Number of environments can't exceed batch size"
+    assert not self.device_history, "Device history can't be used with several environments"
+    # predictions bigger than inference batch would use the model being trained
+    assert not self.learner or self.num_envs <= args.inference_batch_size, "With learner thread number of environments can't exceed inference batch size"
+    self.mems = replay_memory.partitions
+    assert len(self.mems) == self.num_envs
+
+  def _restartRandom(self, index = None):
+    if index is None:
+      for i in xrange(self.num_envs):
+        self._restartRandom(i)
+      return
+    env = self.envs[index]
+    env.restart()
+    frames = env.startFrames()
+    if frames is not None:
+      # dummy actions were already played in background
+      for screen in frames:
+        self.buf.add(screen, index)
+      return
+    # perform random number of dummy actions to produce more stochastic games
+    for i in xrange(random.randint(self.history_length, self.random_starts) + 1):
+      reward = env.act(0)
+      screen = env.getScreen()
+      terminal = env.isTerminal()
+      assert not terminal, "terminal state occurred during random initialization"
+      # add dummy states to buffer
+      self.buf.add(screen, index)
+
+  def step(self, exploration_rate, mems = None):
+    # transitions are added to mems, if given, before screens are reused
+    start = time.time()
+    # exploration rate determines the probability of random moves
+    actions = np.random.randint(self.num_actions, size = self.num_envs)
+    greedy = np.random.random(self.num_envs) >= exploration_rate
+    if np.any(greedy):
+      # predict Q-values for states of all environments at once
+      qvalues = self.net.predict(self.buf.getStateMinibatch(self.num_envs))
+      assert qvalues.shape == (self.num_envs, self.num_actions)
+      actions[greedy] = np.argmax(qvalues[greedy], axis = 1)
+    start = self.timers.add('prediction', start)
+
+    transitions = []
+    for index, (env, action) in enumerate(zip(self.envs, actions)):
+      # perform the action
+      reward = env.act(action)
+      start = self.timers.add('emulation', start)
+      screen = env.getScreen()
+      terminal = env.isTerminal()
+      start = self.timers.add('preprocessing', start)
+
+      # add transition to replay memory partition of environment
+      if mems is not None:
+        mems[index].add(action, reward, screen, terminal)
+        start = self.timers.add('replay', start)
+
+      # add screen to buffer, it refers to replay memory screen when possible
+      if mems is not None and self.share_screens:
+        self.buf.addShared(mems[index], index)
+      else:
+        self.buf.add(screen, index)
+      start = self.timers.add('state_buffer', start)
+
+      # restart the game if over, screen buffer is reused by restart
+      if terminal:
+        screen = screen.copy()
+        self._restartRandom(index)
+        start = self.timers.add('restart', start)
+
+      # call callback to record statistics
+      if self.callback:
+        self.callback.on_step(action, reward, terminal, screen, exploration_rate, index)
+
+      transitions.append((action, reward, screen, terminal))
+    return transitions
+
+  def play_random(self, random_steps):
+    for i in xrange(0, random_steps, self.num_envs):
+      # use exploration rate 1 = completely random
+      self.step(1, self.mems)
+
+  def _trainPipelined(self, train_steps, epoch):
+    self.learner.start(epoch)
+    try:
+      for i in xrange(0, train_steps, self.num_envs):
+        for transition in self.step(self._explorationRate(), self.mems):
+          self.total_train_steps += 1
+          self.learner.addStep()
+    finally:
+      self.learner.stop()
+
+  def train(self, train_steps, epoch = 0):
+    if self.learner:
+      self._trainPipelined(train_steps, epoch)
+      return
+    i = 0
+    while i < train_steps:
+      # perform game step in all environments
+      for transition in self.step(self._explorationRate(), self.mems):
+        # Update target network every target_steps steps
+        if self.target_steps and i % self.target_steps == 0:
+          start = time.time()
+          self.net.update_target_network()
+          self.timers.add('target_sync', start)
+        # train after every train_frequency steps
+        if self.mem.count > self.mem.batch_size and i % self.train_frequency == 0:
+          self.learn(epoch)
+        # increase number of training steps for epsilon decay
+        self.total_train_steps += 1
+        i += 1
+
+  def test(self, test_steps, epoch = 0):
+    # just make sure there is history_length screens to form a state
+    self._restartRandom()
+    # play given number of steps
+    for i in xrange(0, test_steps, self.num_envs):
+      # perform game step
+      self.step(self.exploration_rate_test)
@@ -0,0 +1,210 @@
+# Times hot paths of training separately for all combinations of replay sizes,
+# batch sizes and history lengths. Results are written as JSON, with --compare
+# they are checked against stored baseline and slowdowns above --threshold are
+# reported as regressions.
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+import numpy as np
+from replay_memory import ReplayMemory
+from state_buffer import StateBuffer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--replay_sizes", type=int, nargs='+', default=[10000, 100000], help="Replay memory sizes to benchmark.")
+parser.add_argument("--batch_sizes", type=int, nargs='+', default=[32], help="Minibatch sizes to benchmark.")
+parser.add_argument("--history_lengths", type=int, nargs='+', default=[4], help="History lengths to benchmark.")
+parser.add_argument("--benchmarks", nargs='+', choices=['memory', 'buffer', 'network', 'environment'], default=['memory', 'buffer', 'network', 'environment'], help="Groups of hot paths to benchmark.")
+parser.add_argument("--screen_width", type=int, default=84, help="Screen width after resize.")
+parser.add_argument("--screen_height", type=int, default=84, help="Screen height after resize.")
+parser.add_argument("--replay_storage", choices=["memory", "memmap", "compressed"], default="memory", help="Replay memory storage to benchmark.")
+parser.add_argument('--backend', choices=['cpu', 'gpu', 'numpy'], default='gpu', help='Network backend to benchmark.')
+parser.add_argument('--datatype', choices=['float16', 'float32', 'float64'], default='float32', help='Floating point precision of network.')
+parser.add_argument("--num_actions", type=int, default=6, help="Number of actions of network.")
+parser.add_argument("--game", help="ROM file for benchmarking ALE screens, synthetic environment is used otherwise.")
+parser.add_argument("--loops", type=int, default=1000, help="Number of calls per measurement.")
+parser.add_argument("--network_loops", type=int, default=50, help="Number of network calls per measurement.")
+parser.add_argument("--repeats", type=int, default=3, help="Number of measurements, the fastest is reported.")
+parser.add_argument("--random_seed", type=int, default=1, help="Random seed.")
+parser.add_argument("--output", help="Write results to this JSON file.")
+parser.add_argument("--compare", help="Compare results with this baseline JSON file.")
+parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown compared to baseline reported as regression.")
+args = parser.parse_args()
+
+def make_args(**kwargs):
+  # defaults of main.py for the parts that are benchmarked
+  defaults = dict(
+    screen_width = args.screen_width,
+    screen_height = args.screen_height,
+    screen_crop = None,
+    screen_interpolation = 'linear',
+    replay_storage = args.replay_storage,
+    replay_file = None,
+    replay_chunk_size = 4,
+    replay_cache_chunks = 256,
+    n_step = 1,
+    discount_rate = 0.99,
+    min_reward = -1,
+    max_reward = 1,
+    learning_rate = 0.00025,
+    optimizer = 'rmsprop',
+    decay_rate = 0.95,
+    clip_error = 1,
+    batch_norm = False,
+    device_history = False,
+    inference_batch_size = 1,
+    learner_thread = False,
+    target_steps = 10000,
+    target_update_tau = 0,
+    backend = args.backend,
+    device_id = 0,
+    datatype = args.datatype,
+    stochastic_round = False,
+    save_weights_prefix = None,
+    random_seed = args.random_seed,
+  )
+  defaults.update(kwargs)
+  return argparse.Namespace(**defaults)
+
+def measure(function, loops):
+  # microseconds per call, the fastest of repeated measurements
+  times = []
+  for i in xrange(args.repeats):
+    start = time.time()
+    for j in xrange(loops):
+      function()
+    times.append((time.time() - start) / loops * 1e6)
+  return min(times)
+
+def describe(params):
+  return " ".join("%s=%s" % item for item in sorted(params.items()))
+
+results = []
+def record(name, us, **params):
+  results.append({'name': name, 'params': params, 'us': us})
+  print "%-36s %-50s %12.2f us" % (name, describe(params), us)
+
+def make_screens(count, height, width):
+  # static background with a few moving objects, roughly like Atari games
+  background = np.repeat(np.random.randint(0, 256, size = (height, 1)), width, axis = 1).astype(np.uint8)
+  screens = np.empty((count, height, width), dtype = np.uint8)
+  for i in xrange(count):
+    screens[i] = background
+    for j in xrange(3):
+      y = (i * (j + 1)) % (height - 4)
+      x = (i * (3 - j)) % (width - 4)
+      screens[i, y:y + 4, x:x + 4] = 255
+  return screens
+
+random.seed(args.random_seed)
+np.random.seed(args.random_seed)
+screens = make_screens(1000, args.screen_height, args.screen_width)
+
+if 'memory' in args.benchmarks:
+  for replay_size, history_length, batch_size in itertools.product(args.replay_sizes, args.history_lengths, args.batch_sizes):
+    params = dict(replay_size = replay_size, history_length = history_length, batch_size = batch_size)
+    mem = ReplayMemory(replay_size, make_args(history_length = history_length, batch_size = batch_size))
+    # fill memory first, so that add() also overwrites valid transitions
+    for i in xrange(replay_size):
+      mem.add(0, 0, screens[i % len(screens)], random.random() < 0.01)
+    counter = itertools.count()
+    def add():
+      i = next(counter)
+      mem.add(i % 6, 0, screens[i % len(screens)], i % 100 == 0)
+    record('ReplayMemory.add', measure(add, args.loops), **params)
+    record('ReplayMemory.getMinibatch', measure(mem.getMinibatch, args.loops), **params)
+    record('ReplayMemory.getState', measure(lambda: mem.getState(random.randrange(replay_size)), args.loops), **params)
+    del mem
+
+if 'buffer' in args.benchmarks:
+  for history_length, batch_size in itertools.product(args.history_lengths, args.batch_sizes):
+    params = dict(history_length = history_length, batch_size = batch_size)
+    buf = StateBuffer(make_args(history_length = history_length, batch_size = batch_size))
+    counter = itertools.count()
+    record('StateBuffer.add', measure(lambda: buf.add(screens[next(counter) % len(screens)]), args.loops), **params)
+    record('StateBuffer.getState', measure(buf.getState, args.loops), **params)
+    # training steps refer to screens already in replay memory, timed with ReplayMemory.add
+    mem = ReplayMemory(len(screens), make_args(history_length = history_length, batch_size = batch_size))
+    def addShared():
+      i = next(counter)
+      mem.add(0, 0, screens[i % len(screens)], False)
+      buf.addShared(mem)
+    record('StateBuffer.addShared', measure(addShared, args.loops), **params)
+    record('StateBuffer.getState_shared', measure(buf.getState, args.loops), **params)
+    del mem
+
+if 'network' in args.benchmarks:
+  if args.backend == 'numpy':
+    from numpy_deepqnetwork import NumpyDeepQNetwork as Network
+  else:
+    from deepqnetwork import DeepQNetwork as Network
+  for history_length, batch_size in itertools.product(args.history_lengths, args.batch_sizes):
+    params = dict(history_length = history_length, batch_size = batch_size, backend = args.backend)
+    net = Network(args.num_actions, make_args(history_length = history_length, batch_size = batch_size))
+    shape = (batch_size, history_length, args.screen_height, args.screen_width)
+    states = np.random.randint(256, size = shape).astype(np.uint8)
+    minibatch = (states, np.random.randint(args.num_actions, size = batch_size),
+        np.random.uniform(-1, 1, size = batch_size), np.random.randint(256, size = shape).astype(np.uint8),
+        np.random.random(batch_size) < 0.1)
+    # first calls include allocation and compilation of kernels
+    net.train(minibatch, 0)
+    net.predict(states[:1])
+    if hasattr(net, '_setInput'):
+      # NumPy backend has no separate input upload
+      record('DeepQNetwork._setInput', measure(lambda: net._setInput(states), args.network_loops), **params)
+    record('DeepQNetwork.predict', measure(lambda: net.predict(states[:1]), args.network_loops), **params)
+    record('DeepQNetwork.predict_batch', measure(lambda: net.predict(states), args.network_loops), **params)
+    record('DeepQNetwork.train', measure(lambda: net.train(minibatch, 0), args.network_loops), **params)
+    record('DeepQNetwork.update_target_network', measure(net.update_target_network, args.network_loops), **params)
+    del net
+
+if 'environment' in args.benchmarks:
+  from environment import ALEEnvironment, SyntheticEnvironment
+  env_args = make_args(display_screen = False, frame_skip = 4, repeat_action_probability = 0, color_averaging = True,
+      minimal_action_set = True, frame_max_pool = False, start_states = 0, record_screen_path = None, record_sound_filename = None,
+      synthetic_actions = args.num_actions, synthetic_episode_length = sys.maxint, synthetic_reward_prob = 0.01,
+      synthetic_step_cost = 0, synthetic_screen_width = 160, synthetic_screen_height = 210)
+  if args.game:
+    env = ALEEnvironment(args.game, env_args)
+    name = 'ALEEnvironment'
+  else:
+    env = SyntheticEnvironment(env_args)
+    name = 'SyntheticEnvironment'
+  env.setMode('test')
+  env.restart()
+  params = dict(screen_width = args.screen_width, screen_height = args.screen_height)
+  record(name + '.getScreen', measure(env.getScreen, args.loops), **params)
+
+def key(result):
+  # JSON strings are read back as unicode, so key is formatted as text
+  return "%s %s" % (result['name'], describe(result['params']))
+
+if args.output:
+  info = {
+    'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'machine': platform.node(),
+    'args': vars(args),
+  }
+  with open(args.output, 'w') as f:
+    json.dump({'info': info, 'results': results}, f, indent = 2)
+  print "Results written to %s" % args.output
+
+if args.compare:
+  with open(args.compare) as f:
+    baseline = dict((key(result), result) for result in json.load(f)['results'])
+  regressions = 0
+  for result in results:
+    if key(result) not in baseline:
+      continue
+    change = result['us'] / baseline[key(result)]['us'] - 1
+    if change > args.threshold:
+      regressions += 1
+      print "REGRESSION %-36s %-50s %+.1f%%" % (result['name'], describe(result['params']), change * 100)
+  print "%d regression(s) compared to %s" % (regressions, args.compare)
+  if regressions:
+    sys.exit(1)
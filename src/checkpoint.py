@@ -0,0 +1,269 @@
+import os
+import copy
+import random
+import threading
+import Queue
+import cPickle as pickle
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+class Checkpoint:
+  """
+  Full training state in a folder: network with optimizer states, target
+  network, training counters, random states and replay memory contents.
+  Checkpoint is written in turns to two generation subfolders and file
+  'current' names the last complete one. It is replaced with rename only after
+  the new generation is written, so a crash during saving leaves the previous
+  checkpoint loadable. Replay memory screens are kept in one raw file in each
+  generation, which is updated in chunks and only for screens added since
+  that generation was written, so that saving takes time proportional to the
+  number of new screens. On load screens are copied from memory-mapped file
+  in chunks.
+
+  Only replay memory arrays and counters are copied while adding is blocked,
+  the rest is written in background thread while training continues. Screens
+  added meanwhile can overwrite the oldest ones before they are written, so
+  the checkpoint records how many screens after current could have changed
+  and transitions using them are not sampled after loading.
+  """
+  def __init__(self, path, args):
+    self.path = path
+    self.chunk_size = args.checkpoint_chunk_size
+    self.generations = ['generation0', 'generation1']
+    for generation in self.generations:
+      if not os.path.exists(os.path.join(path, generation)):
+        logger.info("Creating folder %s" % os.path.join(path, generation))
+        os.makedirs(os.path.join(path, generation))
+    # screens added up to this point are already in screens file of generation
+    self.saved_num_added = {}
+    self.thread = None
+    self.error = None
+
+  def _file(self, generation, name):
+    return os.path.join(self.path, generation, name)
+
+  def _current(self):
+    # generation with the last complete checkpoint, None if there is none
+    current_file = os.path.join(self.path, 'current')
+    if not os.path.exists(current_file):
+      return None
+    with open(current_file) as f:
+      return f.read().strip()
+
+  def _memoryArrays(self, mem):
+    names = ['actions', 'rewards', 'terminals', 'valid_indexes', 'valid_positions']
+    if mem.n_step > 1:
+      names += ['returns', 'return_terminals']
+    arrays = [(name, getattr(mem, name)) for name in names]
+    if hasattr(mem, 'tree'):
+      arrays.append(('priorities', mem.tree.tree))
+    return arrays
+
+  def _memoryCounters(self, mem):
+    names = ['count', 'current', 'num_added', 'valid_count']
+    if mem.n_step > 1:
+      names.append('pending')
+    if hasattr(mem, 'tree'):
+      names.append('max_priority')
+    return names
+
+  def _screensFile(self, mem, generation, mode):
+    return np.memmap(self._file(generation, 'screens.bin'), dtype = np.uint8, mode = mode, shape = mem.screens.shape)
+
+  def _saveScreens(self, mem, generation, state):
+    # memory counters at the time of save, memory itself keeps changing
+    current, num_added = state['current'], state['num_added']
+    saved_num_added = self.saved_num_added.get(generation)
+    if saved_num_added is None or not os.path.exists(self._file(generation, 'screens.bin')):
+      # first time this generation is written in this run, write all screens
+      screens = self._screensFile(mem, generation, 'w+')
+      start, num_screens = 0, state['count']
+    else:
+      screens = self._screensFile(mem, generation, 'r+')
+      num_screens = min(num_added - saved_num_added, mem.size)
+      start = (current - num_screens) % mem.size
+    logger.info("Writing %d replay memory screens to checkpoint" % num_screens)
+    written = 0
+    while written < num_screens:
+      # chunks don't wrap over the end of the file
+      first = (start + written) % mem.size
+      last = min(first + self.chunk_size, first + num_screens - written, mem.size)
+      screens[first:last] = mem.screens[first:last]
+      written += last - first
+    screens.flush()
+    del screens
+    # screens added since save started overwrote slots from current on
+    state['overwritten'] = min(mem.num_added - num_added, mem.size)
+
+  def save(self, agent, epoch):
+    # previous checkpoint must be complete before the next one is started
+    self.wait()
+    # overwrite the generation that is not current
+    if self._current() == self.generations[0]:
+      generation = self.generations[1]
+    else:
+      generation = self.generations[0]
+    logger.info("Saving checkpoint to %s" % os.path.join(self.path, generation))
+    # generation is incomplete until it becomes current again
+    self.saved_num_added.pop(generation, None)
+
+    net = agent.net
+    net.model.save_params(self._file(generation, 'network.prm'), keep_states = True)
+    if net.target_model is not net.model:
+      net.target_model.save_params(self._file(generation, 'target.prm'), keep_states = True)
+
+    mem = agent.mem
+    state = {
+      'epoch': epoch,
+      'total_train_steps': agent.total_train_steps,
+      'train_iterations': net.train_iterations,
+      'random_state': random.getstate(),
+      'numpy_random_state': np.random.get_state(),
+    }
+    if hasattr(net.be, 'rng_get_state'):
+      state['backend_random_state'] = net.be.rng_get_state()
+    # adding is blocked only while arrays and counters are copied
+    with mem.lock:
+      arrays = [(name, array.copy()) for name, array in self._memoryArrays(mem)]
+      for name in self._memoryCounters(mem):
+        state[name] = copy.copy(getattr(mem, name))
+    self.thread = threading.Thread(target = self._write, args = (mem, generation, arrays, state))
+    self.thread.start()
+
+  def _write(self, mem, generation, arrays, state):
+    try:
+      for name, array in arrays:
+        np.save(self._file(generation, name + '.npy'), array)
+      self._saveScreens(mem, generation, state)
+      with open(self._file(generation, 'state.pkl'), 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+      # switch to the new generation atomically, when it is completely written
+      current_file = os.path.join(self.path, 'current')
+      with open(current_file + '.tmp', 'w') as f:
+        f.write(generation)
+      os.rename(current_file + '.tmp', current_file)
+      self.saved_num_added[generation] = state['num_added']
+      logger.info("Checkpoint saved to %s" % os.path.join(self.path, generation))
+    except Exception as e:
+      logger.exception("Failed to save checkpoint to %s" % os.path.join(self.path, generation))
+      self.error = e
+
+  def wait(self):
+    # wait until checkpoint being saved is complete
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      raise self.error
+
+  def load(self, agent):
+    self.wait()
+    generation = self._current()
+    assert generation is not None, "No complete checkpoint in " + self.path
+    logger.info("Loading checkpoint from %s" % os.path.join(self.path, generation))
+    with open(self._file(generation, 'state.pkl'), 'rb') as f:
+      state = pickle.load(f)
+
+    net = agent.net
+    net.model.load_params(self._file(generation, 'network.prm'), load_states = True)
+    if net.target_model is not net.model:
+      net.target_model.load_params(self._file(generation, 'target.prm'), load_states = True)
+    net.sync_acting_weights()
+    net.train_iterations = state['train_iterations']
+    agent.total_train_steps = state['total_train_steps']
+    random.setstate(state['random_state'])
+    np.random.set_state(state['numpy_random_state'])
+    if 'backend_random_state' in state and hasattr(net.be, 'rng_set_state'):
+      net.be.rng_set_state(state['backend_random_state'])
+
+    mem = agent.mem
+    with mem.lock:
+      for name, array in self._memoryArrays(mem):
+        array[...] = np.load(self._file(generation, name + '.npy'), mmap_mode = 'r')
+      for name in self._memoryCounters(mem):
+        setattr(mem, name, state[name])
+      screens = self._screensFile(mem, generation, 'r')
+      for first in xrange(0, mem.count, self.chunk_size):
+        last = min(first + self.chunk_size, mem.count)
+        mem.screens[first:last] = screens[first:last]
+      del screens
+      # transition uses screens from history_length before it, these may
+      # be newer than the rest of checkpoint
+      for i in xrange(state.get('overwritten', 0) + mem.history_length):
+        mem._removeValid((mem.current + i) % mem.size)
+    # screens file matches memory now, saving to this generation only writes new screens
+    self.saved_num_added = {generation: mem.num_added}
+    logger.info("Loaded replay memory with %d screens" % mem.count)
+    return state['epoch']
+
+class WeightWriter:
+  """
+  Saves network weights in background thread. Parameters are copied to host
+  memory when save() is called and training can continue right away, while
+  the copy is written to temporary file and renamed, so that a crash never
+  leaves partially written weights file. Optionally keeps only weights of
+  the last epochs and in addition the epochs with best test reward.
+  """
+  def __init__(self, args):
+    self.keep_last = args.save_weights_keep_last
+    self.keep_best = args.save_weights_keep_best
+    # queue size 1 lets one snapshot wait while previous one is written
+    self.queue = Queue.Queue(maxsize = 1)
+    self.thread = None
+    self.error = None
+    # (filename, score) of written files, in order of writing
+    self.saved = []
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      net, weights, filename, score = item
+      try:
+        net.write_weights(weights, filename + '.tmp')
+        os.rename(filename + '.tmp', filename)
+        self.saved.append((filename, score))
+        self._removeOld()
+      except Exception as e:
+        logger.exception("Failed to write weights to %s" % filename)
+        self.error = e
+
+  def _removeOld(self):
+    # keep_last 0 keeps all weights, best ones are kept in addition to last ones
+    if not self.keep_last:
+      return
+    # the file just written is always among the last ones
+    keep = set(filename for filename, score in self.saved[-self.keep_last:])
+    if self.keep_best:
+      # epochs without test reward are never among the best
+      scored = [(score, filename) for filename, score in self.saved if score is not None]
+      scored.sort(reverse = True)
+      keep.update(filename for score, filename in scored[:self.keep_best])
+    for filename, score in self.saved:
+      if filename not in keep:
+        logger.info("Removing old weights %s" % filename)
+        os.remove(filename)
+    self.saved = [(filename, score) for filename, score in self.saved if filename in keep]
+
+  def save(self, net, filename, score = None):
+    if self.error is not None:
+      raise self.error
+    if self.thread is None:
+      self.thread = threading.Thread(target = self._run)
+      self.thread.daemon = True
+      self.thread.start()
+    # parameters are copied to host before training continues
+    weights = net.get_weights()
+    self.queue.put((net, weights, filename, score))
+
+  def close(self):
+    # wait until all weights are written
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      raise self.error
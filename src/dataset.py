@@ -0,0 +1,65 @@
+import os
+import cPickle as pickle
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+def export_dataset(mem, path, num_actions, chunk_size):
+  """
+  Writes replay memory contents to folder as chunks of consecutive
+  transitions, oldest first. Each chunk is a separate file, so that
+  datasets can be streamed without loading them fully to memory.
+  """
+  if not os.path.exists(path):
+    logger.info("Creating folder %s" % path)
+    os.makedirs(path)
+  # oldest transition is at current pointer when memory is full
+  if mem.count < mem.size:
+    indexes = np.arange(mem.count)
+  else:
+    indexes = np.roll(np.arange(mem.size), -mem.current)
+  logger.info("Exporting %d transitions to %s" % (len(indexes), path))
+  num_chunks = 0
+  with mem.lock:
+    for start in xrange(0, len(indexes), chunk_size):
+      chunk = indexes[start:start + chunk_size]
+      np.savez_compressed(os.path.join(path, "chunk_%06d.npz" % num_chunks),
+          actions = mem.actions[chunk],
+          rewards = mem.rewards[chunk],
+          screens = mem.screens.take(chunk, axis = 0, mode = 'wrap'),
+          terminals = mem.terminals[chunk])
+      num_chunks += 1
+  info = {
+    'num_actions': num_actions,
+    'num_chunks': num_chunks,
+    'num_transitions': len(indexes),
+    'dims': mem.dims,
+  }
+  with open(os.path.join(path, "dataset.pkl"), "wb") as f:
+    pickle.dump(info, f, pickle.HIGHEST_PROTOCOL)
+
+def read_info(path):
+  with open(os.path.join(path, "dataset.pkl"), "rb") as f:
+    return pickle.load(f)
+
+def read_chunks(path, loop = True):
+  # reads one chunk at a time, starting from beginning when loop is set
+  info = read_info(path)
+  while True:
+    for i in xrange(info['num_chunks']):
+      with np.load(os.path.join(path, "chunk_%06d.npz" % i)) as data:
+        chunk = (data['actions'], data['rewards'], data['screens'], data['terminals'])
+      if i == info['num_chunks'] - 1:
+        # dataset ends mid-episode, mark it as terminal, so that histories
+        # don't span the end and beginning of dataset when looping
+        chunk[3][-1] = True
+      yield chunk
+    if not loop:
+      break
+    logger.info("Reached end of dataset %s, starting again" % path)
+
+def read_transitions(path, loop = True):
+  # stream transitions in the order of replay memory add() arguments
+  for actions, rewards, screens, terminals in read_chunks(path, loop):
+    for i in xrange(len(actions)):
+      yield actions[i], rewards[i], screens[i], terminals[i]
@@ -7,8 +7,11 @@ from neon.transforms import Rectlin
 from neon.models import Model
 from neon.transforms import SumSquared
 from neon.util.persist import save_obj
+from timers import Timers
 import numpy as np
 import os
+import time
+import threading
 import logging
 logger = logging.getLogger(__name__)
 
@@ -17,7 +20,9 @@ class DeepQNetwork:
     # remember parameters
     self.num_actions = num_actions
     self.batch_size = args.batch_size
-    self.discount_rate = args.discount_rate
+    self.n_step = args.n_step
+    # n-step returns are bootstrapped from the state n steps later
+    self.discount_rate = args.discount_rate ** args.n_step
     self.history_length = args.history_length
     self.screen_dim = (args.screen_height, args.screen_width)
     self.clip_error = args.clip_error
@@ -38,6 +43,8 @@ class DeepQNetwork:
     self.input = self.be.empty(self.input_shape)
     self.input.lshape = self.input_shape # HACK: needed for convolutional networks
     self.targets = self.be.empty((self.num_actions, self.batch_size))
+    self.weights = self.be.empty((1, self.batch_size))
+    self.batch_indexes = np.arange(self.batch_size)
 
     # create model
     layers = self._createLayers(num_actions)
@@ -62,18 +69,75 @@ class DeepQNetwork:
 
     # create target model
     self.train_iterations = 0
-    if args.target_steps:
+    self.target_update_tau = args.target_update_tau
+    if args.target_steps or self.target_update_tau:
       self.target_model = Model(layers = self._createLayers(num_actions))
       # Bug fix
       for l in self.target_model.layers.layers:
         l.parallelism = 'Disabled'
       self.target_model.initialize(self.input_shape[:-1])
       self.save_weights_prefix = args.save_weights_prefix
+      # pairs of parameter tensors, so that target network can be
+      # updated in place without going through host memory
+      self.target_params = self._paramPairs(self.model, self.target_model)
+      self.update_target_network()
     else:
       self.target_model = self.model
+      self.target_params = []
+
+    # create smaller model for predicting actions, that shares weights
+    # with the training model, because Neon fixes batch size of layers,
+    # with learner thread the model has its own copy of weights for acting
+    self.acting_lock = threading.Lock()
+    self.acting_params = []
+    if args.learner_thread or 0 < args.inference_batch_size < self.batch_size:
+      self.inference_batch_size = min(args.inference_batch_size, self.batch_size) or self.batch_size
+      self.inference_input_shape = self.input_shape[:-1] + (self.inference_batch_size,)
+      self.inference_input = self.be.empty(self.inference_input_shape)
+      self.inference_input.lshape = self.inference_input_shape # HACK: needed for convolutional networks
+      # layers allocate their buffers using backend batch size
+      self.be.bsz = self.inference_batch_size
+      self.inference_model = Model(layers = self._createLayers(num_actions))
+      # Bug fix
+      for l in self.inference_model.layers.layers:
+        l.parallelism = 'Disabled'
+      self.inference_model.initialize(self.inference_input_shape[:-1])
+      self.be.bsz = self.batch_size
+      if args.learner_thread:
+        self.acting_params = self._paramPairs(self.model, self.inference_model)
+        self.sync_acting_weights()
+      else:
+        self._shareWeights(self.model, self.inference_model)
+    else:
+      self.inference_batch_size = self.batch_size
+      self.inference_input = self.input
+      self.inference_model = self.model
+
+    # frame history for acting is kept in backend memory as a ring, where
+    # each frame is written twice, so that the latest history_length frames
+    # are always contiguous and can be used as input without copying
+    if args.device_history:
+      assert self.inference_batch_size == 1, "Device history needs --inference_batch_size 1"
+      self.frame_size = np.prod(self.screen_dim)
+      self.frame = self.be.empty((self.frame_size, 1))
+      self.history = self.be.zeros((2 * self.history_length * self.frame_size, 1))
+      self.history_views = []
+      for i in xrange(self.history_length):
+        view = self.history[(i + 1) * self.frame_size:(i + 1 + self.history_length) * self.frame_size]
+        view.lshape = self.inference_input_shape # HACK: needed for convolutional networks
+        self.history_views.append(view)
+      self.history_position = 0
+      self.history_view = self.history_views[-1]
+
+    # host buffer for padding partial batches
+    self.padded_states = np.zeros((self.batch_size, self.history_length) + self.screen_dim, dtype = np.uint8)
 
     self.callback = None
 
+    # wall-clock time of training phases, with GPU backend kernels run
+    # asynchronously and their time shows up where results are copied to host
+    self.timers = Timers(['forward', 'backward'])
+
   def _createLayers(self, num_actions):
     # create network
     init_xavier_conv = Xavier(local=True)
@@ -91,20 +155,55 @@ class DeepQNetwork:
     layers.append(Affine(nout=num_actions, init = init_xavier_affine))
     return layers
 
-  def _setInput(self, states):
+  def _paramPairs(self, src_model, dst_model):
+    # parameter tensors of both models, including batch normalization states
+    pairs = []
+    for src_layer, dst_layer in zip(src_model.layers_to_optimize, dst_model.layers_to_optimize):
+      for name in ('W', 'beta', 'gamma', 'gmean', 'gvar'):
+        if hasattr(src_layer, name):
+          pairs.append((getattr(src_layer, name), getattr(dst_layer, name)))
+    return pairs
+
+  def _shareWeights(self, src_model, dst_model):
+    # make layers of dst_model use parameter tensors of src_model
+    for src_layer, dst_layer in zip(src_model.layers_to_optimize, dst_model.layers_to_optimize):
+      for name in ('W', 'beta', 'gamma', 'gmean', 'gvar'):
+        if hasattr(src_layer, name):
+          setattr(dst_layer, name, getattr(src_layer, name))
+
+  def _setInput(self, states, input = None):
+    if input is None:
+      input = self.input
+    # pad partial batch, Q-values of padding rows are discarded
+    batch_size = input.shape[-1]
+    if states.shape[0] < batch_size:
+      self.padded_states[:states.shape[0]] = states
+      states = self.padded_states[:batch_size]
     # change order of axes to match what Neon expects
     states = np.transpose(states, axes = (1, 2, 3, 0))
     # copy() shouldn't be necessary here, but Neon doesn't work otherwise
-    self.input.set(states.copy())
+    input.set(states.copy())
     # normalize network input between 0 and 1
-    self.be.divide(self.input, 255, self.input)
+    self.be.divide(input, 255, input)
+
+  def sync_acting_weights(self):
+    # copy weights used for acting, learner thread calls this between updates
+    with self.acting_lock:
+      for src, dst in self.acting_params:
+        dst[:] = src
 
   def update_target_network(self):
-      # have to serialize also states for batch normalization to work
-      pdict = self.model.get_description(get_weights=True, keep_states=True)
-      self.target_model.deserialize(pdict, load_states=True)
+    # copy parameters and batch normalization states in place
+    for src, dst in self.target_params:
+      dst[:] = src
 
-  def train(self, minibatch, epoch):
+  def _softUpdateTargetNetwork(self):
+    # move target network slowly towards main network
+    tau = self.target_update_tau
+    for src, dst in self.target_params:
+      dst[:] = tau * src + (1 - tau) * dst
+
+  def train(self, minibatch, epoch, weights = None):
     # expand components of minibatch
     prestates, actions, rewards, poststates, terminals = minibatch
     assert len(prestates.shape) == 4
@@ -114,6 +213,7 @@ class DeepQNetwork:
     assert len(terminals.shape) == 1
     assert prestates.shape == poststates.shape
     assert prestates.shape[0] == actions.shape[0] == rewards.shape[0] == poststates.shape[0] == terminals.shape[0]
+    start = time.time()
 
     # feed-forward pass for poststates to get Q-values
     self._setInput(poststates)
@@ -130,10 +230,13 @@ class DeepQNetwork:
     assert preq.shape == (self.num_actions, self.batch_size)
 
     # make copy of prestate Q-values as targets
-    targets = preq.asnumpyarray().copy()
+    preq_host = preq.asnumpyarray()
+    targets = preq_host.copy()
 
-    # clip rewards between -1 and 1
-    rewards = np.clip(rewards, self.min_reward, self.max_reward)
+    # clip rewards between -1 and 1,
+    # n-step returns are sums of rewards clipped by replay memory
+    if self.n_step == 1:
+      rewards = np.clip(rewards, self.min_reward, self.max_reward)
 
     # update Q-value targets for actions taken
     for i, action in enumerate(actions):
@@ -142,9 +245,14 @@ class DeepQNetwork:
       else:
         targets[action, i] = float(rewards[i]) + self.discount_rate * maxpostq[0,i]
 
+    # TD errors of actions taken, used for replay priorities
+    errors = targets[actions, self.batch_indexes] - preq_host[actions, self.batch_indexes]
+
     # copy targets to GPU memory
     self.targets.set(targets)
 
+    start = self.timers.add('forward', start)
+
     # calculate errors
     deltas = self.cost.get_errors(preq, self.targets)
     assert deltas.shape == (self.num_actions, self.batch_size)
@@ -158,35 +266,84 @@ class DeepQNetwork:
     if self.clip_error:
       self.be.clip(deltas, -self.clip_error, self.clip_error, out = deltas)
 
+    # scale errors with importance sampling weights
+    if weights is not None:
+      self.weights.set(weights.reshape((1, self.batch_size)))
+      deltas[:] = deltas * self.weights
+
     # perform back-propagation of gradients
     self.model.bprop(deltas)
 
     # perform optimization
     self.optimizer.optimize(self.model.layers_to_optimize, epoch)
 
+    # soft update of target network after every weight update
+    if self.target_update_tau:
+      self._softUpdateTargetNetwork()
+
     # increase number of weight updates (needed for stats callback)
     self.train_iterations += 1
 
     # calculate statistics
     if self.callback:
       self.callback.on_train(cost[0,0])
+    self.timers.add('backward', start)
+
+    return errors
 
   def predict(self, states):
-    # minibatch is full size, because Neon doesn't let change the minibatch size
-    assert states.shape == ((self.batch_size, self.history_length,) + self.screen_dim)
+    # Neon doesn't let change the minibatch size, so use the smallest model
+    # that fits the states and pad the rest of the minibatch
+    num_states = states.shape[0]
+    assert 0 < num_states <= self.batch_size
+    assert states.shape[1:] == ((self.history_length,) + self.screen_dim)
+    if num_states <= self.inference_batch_size:
+      model, input, batch_size = self.inference_model, self.inference_input, self.inference_batch_size
+    else:
+      # with learner thread this happens only when learner is stopped
+      model, input, batch_size = self.model, self.input, self.batch_size
 
     # calculate Q-values for the states
-    self._setInput(states)
-    qvalues = self.model.fprop(self.input, inference = True)
-    assert qvalues.shape == (self.num_actions, self.batch_size)
-    if logger.isEnabledFor(logging.DEBUG):
-      logger.debug("Q-values: " + str(qvalues.asnumpyarray()[:,0]))
+    with self.acting_lock:
+      self._setInput(states, input)
+      qvalues = model.fprop(input, inference = True)
+      assert qvalues.shape == (self.num_actions, batch_size)
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Q-values: " + str(qvalues.asnumpyarray()[:,0]))
+
+      # transpose the result, so that batch size is first dimension
+      return qvalues.T.asnumpyarray()[:num_states]
+
+  def addFrame(self, screen):
+    # upload and normalize only the newest frame
+    self.frame.set(screen.reshape((self.frame_size, 1)))
+    p = self.history_position
+    self.history[p * self.frame_size:(p + 1) * self.frame_size] = self.frame / 255.
+    p += self.history_length
+    self.history[p * self.frame_size:(p + 1) * self.frame_size] = self.frame / 255.
+    # latest frames start after the oldest copy of the newest frame
+    self.history_view = self.history_views[self.history_position]
+    self.history_position = (self.history_position + 1) % self.history_length
+
+  def predictHistory(self):
+    # calculate Q-values for the state formed by frames given to addFrame()
+    with self.acting_lock:
+      qvalues = self.inference_model.fprop(self.history_view, inference = True)
+      assert qvalues.shape == (self.num_actions, 1)
+      return qvalues.T.asnumpyarray()
+
+  def get_weights(self):
+    # same description as Model.save_params(), parameters are copied to host
+    return self.model.get_description(get_weights = True, keep_states = True)
 
-    # transpose the result, so that batch size is first dimension
-    return qvalues.T.asnumpyarray()
+  def write_weights(self, weights, save_path):
+    save_obj(weights, save_path)
 
   def load_weights(self, load_path):
     self.model.load_params(load_path)
+    self.sync_acting_weights()
+    # target network starts from loaded weights, not random initialization
+    self.update_target_network()
 
   def save_weights(self, save_path):
     self.model.save_params(save_path)
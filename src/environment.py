@@ -1,7 +1,13 @@
 import sys
 import os
+import copy
+import random
+import threading
+import Queue
+import time
 import logging
-import cv2
+import numpy as np
+from preprocessing import Preprocessor
 logger = logging.getLogger(__name__)
 
 class Environment:
@@ -32,6 +38,23 @@ class Environment:
     # Set training/test mode. Not used in Gym environment
     self.mode = mode
 
+  def startFrames(self):
+    # Returns history of prepared start state after restart, or None if
+    # dummy actions must be played
+    return None
+
+class VectorEnvironment(Environment):
+  # several environments of the same game, stepped in lockstep by VectorAgent
+  def __init__(self, envs):
+    self.envs = envs
+
+  def numActions(self):
+    return self.envs[0].numActions()
+
+  def setMode(self, mode):
+    for env in self.envs:
+      env.setMode(mode)
+
 class ALEEnvironment(Environment):
   def __init__(self, rom_file, args):
     from ale_python_interface import ALEInterface
@@ -45,7 +68,10 @@ class ALEEnvironment(Environment):
         self.ale.setBool('sound', True)
       self.ale.setBool('display_screen', True)
 
-    self.ale.setInt('frame_skip', args.frame_skip)
+    # with max pooling frames are skipped here, so that the last two are seen
+    self.frame_skip = args.frame_skip
+    self.max_pool = args.frame_max_pool
+    self.ale.setInt('frame_skip', 1 if self.max_pool else args.frame_skip)
     self.ale.setFloat('repeat_action_probability', args.repeat_action_probability)
     self.ale.setBool('color_averaging', args.color_averaging)
 
@@ -74,11 +100,22 @@ class ALEEnvironment(Environment):
       logger.info("Using full action set with size %d" % len(self.actions))
     logger.debug("Actions: " + str(self.actions))
 
-    self.screen_width = args.screen_width
-    self.screen_height = args.screen_height
+    # raw screens are read into preallocated buffers in ALE format
+    width, height = self.ale.getScreenDims()
+    self.raw_screens = np.zeros((2, height, width, 1), dtype = np.uint8)
+    self.pooled_screen = np.zeros((height, width, 1), dtype = np.uint8)
+    self.raw_index = 0
+    self.preprocessor = Preprocessor(args)
 
     self.life_lost = False
 
+    # start states are played in advance by another emulator
+    self.start_frames = None
+    if args.start_states:
+      self.start_states = StartStatePool(rom_file, args)
+    else:
+      self.start_states = None
+
   def numActions(self):
     return len(self.actions)
 
@@ -92,25 +129,185 @@ class ALEEnvironment(Environment):
         not self.life_lost or  # `reset` called in a middle of episode
         self.ale.game_over()  # all lives are lost
     ):
+      if self.start_states:
+        # restoring replaces the whole emulator state, no need to reset
+        self.restoreStartState(self.start_states.get())
+        return
       self.ale.reset_game()
     self.life_lost = False
+    self.start_frames = None
+    if self.max_pool:
+      # there is no previous frame to take maximum with
+      self.ale.getScreenGrayscale(self.raw_screens[0])
+      self.raw_screens[1] = self.raw_screens[0]
+
+  def restoreStartState(self, start_state):
+    state, frames, raw_screens = start_state
+    self.ale.restoreState(state)
+    self.raw_screens[...] = raw_screens
+    self.life_lost = False
+    self.start_frames = frames
+
+  def cloneStartState(self, frames):
+    return (self.ale.cloneState(), frames, self.raw_screens.copy())
+
+  def startFrames(self):
+    frames = self.start_frames
+    self.start_frames = None
+    return frames
 
   def act(self, action):
     lives = self.ale.lives()
-    reward = self.ale.act(self.actions[action])
+    if self.max_pool:
+      reward = 0
+      for i in xrange(self.frame_skip):
+        reward += self.ale.act(self.actions[action])
+        # keep the last two frames in alternating buffers
+        self.raw_index = 1 - self.raw_index
+        self.ale.getScreenGrayscale(self.raw_screens[self.raw_index])
+        if self.ale.game_over():
+          break
+    else:
+      reward = self.ale.act(self.actions[action])
     self.life_lost = (not lives == self.ale.lives())
     return reward
 
   def getScreen(self):
-    screen = self.ale.getScreenGrayscale()
-    resized = cv2.resize(screen, (self.screen_width, self.screen_height))
-    return resized
+    # returned screen is overwritten by the next call
+    if self.max_pool:
+      # maximum over the last two frames removes flickering of sprites
+      np.maximum(self.raw_screens[0], self.raw_screens[1], out = self.pooled_screen)
+      screen = self.pooled_screen
+    else:
+      screen = self.ale.getScreenGrayscale(self.raw_screens[0])
+    return self.preprocessor.process(screen[..., 0])
 
   def isTerminal(self):
     if self.mode == 'train':
       return self.ale.game_over() or self.life_lost
     return self.ale.game_over()
 
+class StartStatePool:
+  """
+  Pool of game start states, each played with random number of dummy actions
+  like Agent does after restart and cloned together with its screen history.
+  Another emulator plays new start states in background thread. Restart takes
+  a new start state when one is ready and reuses a random pooled one
+  otherwise, so that there are always as many different starts as before.
+  Which one is used depends on thread timing, so with random seed restart
+  waits for the next new start state instead, to keep runs repeatable.
+  """
+  def __init__(self, rom_file, args):
+    self.history_length = args.history_length
+    self.random_starts = args.random_starts
+    # emulator of the pool is not displayed nor recorded
+    pool_args = copy.copy(args)
+    pool_args.display_screen = False
+    pool_args.record_screen_path = None
+    pool_args.record_sound_filename = None
+    pool_args.start_states = 0
+    if args.random_seed:
+      pool_args.random_seed = args.random_seed + 1
+    # background thread must not draw from random numbers of the agent
+    self.random = random.Random(pool_args.random_seed or None)
+    self.wait = bool(args.random_seed)
+    self.env = ALEEnvironment(rom_file, pool_args)
+    self.env.setMode('test')
+
+    logger.info("Playing %d start states" % args.start_states)
+    self.states = [self._play() for i in xrange(args.start_states)]
+    self.ready = Queue.Queue(args.start_states)
+    self.thread = threading.Thread(target = self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _play(self):
+    while True:
+      self.env.restart()
+      frames = np.empty((self.history_length,) + self.env.preprocessor.output.shape, dtype = np.uint8)
+      num_actions = self.random.randint(self.history_length, self.random_starts) + 1
+      for i in xrange(num_actions):
+        self.env.act(0)
+        if self.env.isTerminal():
+          break
+        # only the last history_length screens form the start state
+        if i >= num_actions - self.history_length:
+          frames[i - num_actions + self.history_length] = self.env.getScreen()
+      else:
+        return self.env.cloneStartState(frames)
+      logger.warn("Terminal state occurred while playing start state, retrying")
+
+  def _run(self):
+    # ALE releases GIL while emulating, so this runs in parallel with agent
+    while True:
+      self.ready.put(self._play())
+
+  def get(self):
+    try:
+      start_state = self.ready.get(self.wait)
+      # new start state replaces random pooled one, which is released
+      index = random.randrange(len(self.states))
+      self.env.ale.deleteState(self.states[index][0])
+      self.states[index] = start_state
+    except Queue.Empty:
+      logger.debug("No new start state ready, reusing pooled one")
+      start_state = random.choice(self.states)
+    return start_state
+
+class SyntheticEnvironment(Environment):
+  """
+  Stand-in for emulator, used for benchmarking and testing without ROMs,
+  repeatable with random seed. Screen is static background with object
+  moving over it and goes through the same preprocessing as ALE screens.
+  Agent gets reward with reward_prob probability, 1 if action matches
+  position of the object and -1 otherwise. Episode ends after episode_length steps. Emulation time can be
+  simulated with step_cost seconds of sleep per step.
+  """
+  def __init__(self, args):
+    # seed is offset by index of environment or actor, without seed
+    # each environment draws its own random numbers
+    self.random = np.random.RandomState(args.random_seed or None)
+    self.num_actions = args.synthetic_actions
+    self.episode_length = args.synthetic_episode_length
+    self.reward_prob = args.synthetic_reward_prob
+    self.step_cost = args.synthetic_step_cost
+    height, width = args.synthetic_screen_height, args.synthetic_screen_width
+    self.background = np.repeat(self.random.randint(0, 256, size = (height, 1)), width, axis = 1).astype(np.uint8)
+    self.raw_screen = self.background.copy()
+    self.preprocessor = Preprocessor(args)
+    self.steps = 0
+    self.position = 0
+
+  def numActions(self):
+    return self.num_actions
+
+  def restart(self):
+    self.steps = 0
+    self.position = self.random.randint(self.num_actions)
+
+  def act(self, action):
+    if self.step_cost:
+      time.sleep(self.step_cost)
+    self.steps += 1
+    if self.random.random_sample() < self.reward_prob:
+      reward = 1 if action == self.position else -1
+    else:
+      reward = 0
+    # object moves randomly one position left or right
+    self.position = (self.position + self.random.randint(-1, 2)) % self.num_actions
+    return reward
+
+  def getScreen(self):
+    # returned screen is overwritten by the next call
+    height, width = self.raw_screen.shape
+    size = width // self.num_actions
+    self.raw_screen[...] = self.background
+    self.raw_screen[height // 2:height // 2 + size, self.position * size:(self.position + 1) * size] = 255
+    return self.preprocessor.process(self.raw_screen)
+
+  def isTerminal(self):
+    return self.steps >= self.episode_length
+
 class GymEnvironment(Environment):
   # For use with Open AI Gym Environment
   def __init__(self, env_id, args):
@@ -118,9 +315,7 @@ class GymEnvironment(Environment):
     self.gym = gym.make(env_id)
     self.obs = None
     self.terminal = None
-
-    self.screen_width = args.screen_width
-    self.screen_height = args.screen_height
+    self.preprocessor = Preprocessor(args)
 
   def numActions(self):
     import gym
@@ -137,7 +332,8 @@ class GymEnvironment(Environment):
 
   def getScreen(self):
     assert self.obs is not None
-    return cv2.resize(cv2.cvtColor(self.obs, cv2.COLOR_RGB2GRAY), (self.screen_width, self.screen_height))
+    # returned screen is overwritten by the next call
+    return self.preprocessor.processRGB(self.obs)
 
   def isTerminal(self):
     assert self.terminal is not None
@@ -0,0 +1,140 @@
+import numpy as np
+import zlib
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+class CompressedFrameStore:
+  """
+  Drop-in replacement for replay memory screens array, which keeps frames
+  compressed in chunks of consecutive frames. Each frame in chunk is stored
+  as difference from the previous one, which makes static background
+  compress well. Frames are written sequentially into uncompressed open
+  chunk, which is compressed when the chunk is full or another chunk is
+  written. Only chunks touched by reads are decompressed and the most
+  recently used decoded chunks are cached.
+  """
+  def __init__(self, shape, chunk_size, cache_chunks, compress_level = 1):
+    self.shape = shape
+    self.dtype = np.dtype(np.uint8)
+    self.size = shape[0]
+    self.dims = shape[1:]
+    self.chunk_size = chunk_size
+    self.cache_chunks = cache_chunks
+    self.compress_level = compress_level
+
+    num_chunks = (self.size + chunk_size - 1) // chunk_size
+    self.chunks = [None] * num_chunks
+    self.compressed_bytes = 0
+    self.cache = OrderedDict()
+
+    # preallocate buffers for open chunk and encoding
+    self.open_chunk = None
+    self.open_buffer = np.zeros((chunk_size,) + self.dims, dtype = np.uint8)
+    self.deltas = np.empty((chunk_size,) + self.dims, dtype = np.uint8)
+
+  def _encode(self, frames):
+    # uint8 arithmetic wraps around, so summing in _decode restores frames exactly
+    self.deltas[0] = frames[0]
+    np.subtract(frames[1:], frames[:-1], out = self.deltas[1:])
+    return zlib.compress(self.deltas.tobytes(), self.compress_level)
+
+  def _decode(self, data, out = None):
+    deltas = np.frombuffer(zlib.decompress(data, 15, self.open_buffer.nbytes), dtype = np.uint8).reshape(self.open_buffer.shape)
+    if out is None:
+      out = np.empty_like(deltas)
+    # running sum frame by frame is much faster than cumsum over first axis
+    out[0] = deltas[0]
+    for i in xrange(1, self.chunk_size):
+      np.add(out[i - 1], deltas[i], out = out[i])
+    return out
+
+  def _closeChunk(self):
+    if self.open_chunk is None:
+      return
+    data = self._encode(self.open_buffer)
+    old = self.chunks[self.open_chunk]
+    self.compressed_bytes += len(data) - (len(old) if old is not None else 0)
+    self.chunks[self.open_chunk] = data
+    self.open_chunk = None
+
+  def _openChunk(self, chunk):
+    self._closeChunk()
+    # keep frames of the chunk, that are not overwritten yet
+    if self.chunks[chunk] is not None:
+      self._decode(self.chunks[chunk], out = self.open_buffer)
+    else:
+      self.open_buffer.fill(0)
+    self.cache.pop(chunk, None)
+    self.open_chunk = chunk
+
+  def _getChunk(self, chunk):
+    if chunk == self.open_chunk:
+      return self.open_buffer
+    frames = self.cache.pop(chunk, None)
+    if frames is None:
+      data = self.chunks[chunk]
+      if data is None:
+        # never written, behave like uninitialized array
+        return self.open_buffer * 0
+      frames = self._decode(data)
+      if len(self.cache) >= self.cache_chunks:
+        self.cache.popitem(last = False)
+    # reinserting moves chunk to the end of least recently used order
+    self.cache[chunk] = frames
+    return frames
+
+  def _setFrame(self, index, frame):
+    chunk, offset = divmod(index, self.chunk_size)
+    if chunk != self.open_chunk:
+      self._openChunk(chunk)
+    self.open_buffer[offset] = frame
+    # compress right away when the last frame of chunk is written
+    if offset == self.chunk_size - 1 or index == self.size - 1:
+      self._closeChunk()
+
+  def _indexes(self, key):
+    # support indexing used by replay memory: int, slice or array,
+    # optionally followed by ellipsis
+    if isinstance(key, tuple):
+      assert all(k is Ellipsis for k in key[1:]), "Only first axis can be indexed"
+      key = key[0]
+    if isinstance(key, slice):
+      return np.arange(*key.indices(self.size))
+    return key
+
+  def __setitem__(self, key, value):
+    indexes = self._indexes(key)
+    if np.isscalar(indexes):
+      self._setFrame(indexes, value)
+    else:
+      value = np.broadcast_to(value, (len(indexes),) + self.dims)
+      for index, frame in zip(indexes, value):
+        self._setFrame(index, frame)
+
+  def __getitem__(self, key):
+    return self.take(self._indexes(key), axis = 0)
+
+  def __len__(self):
+    return self.size
+
+  def take(self, indexes, axis = 0, out = None, mode = 'wrap'):
+    assert axis == 0, "Only first axis can be indexed"
+    assert mode == 'wrap', "Only wrap mode is supported"
+    indexes = np.asarray(indexes) % self.size
+    if out is None:
+      out = np.empty(indexes.shape + self.dims, dtype = np.uint8)
+    flat_indexes = indexes.reshape(-1)
+    flat_out = out.reshape((-1,) + self.dims)
+    chunks, offsets = np.divmod(flat_indexes, self.chunk_size)
+    # decode each touched chunk once, even if many frames come from it
+    for chunk in np.unique(chunks):
+      mask = (chunks == chunk)
+      flat_out[mask] = self._getChunk(chunk)[offsets[mask]]
+    return out
+
+  def compressionRatio(self):
+    written = sum(1 for data in self.chunks if data is not None) * self.chunk_size
+    if not self.compressed_bytes:
+      return 1
+    return float(written * np.prod(self.dims)) / self.compressed_bytes
@@ -0,0 +1,109 @@
+import threading
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+class LearnerThread:
+  """
+  Trains the network in background thread while agent keeps acting, so that
+  emulator and network run at the same time. Learner keeps the number of
+  minibatch updates at replay_ratio per environment step, agent waits if
+  learner falls more than max_lag updates behind. Acting uses its own copy
+  of weights, which learner updates every acting_sync_updates updates.
+  """
+  def __init__(self, agent, args):
+    self.agent = agent
+    self.net = agent.net
+    self.mem = agent.mem
+    # by default the same ratio as with sequential training
+    self.replay_ratio = args.replay_ratio or float(args.train_repeat) / args.train_frequency
+    self.train_repeat = args.train_repeat
+    self.max_lag = args.learner_max_lag
+    self.target_steps = args.target_steps
+    self.acting_sync_updates = args.acting_sync_updates
+
+    self.condition = threading.Condition()
+    self.thread = None
+    self.running = False
+    self.error = None
+    # counted over the whole run, so that ratio is kept between epochs
+    self.steps = 0
+    self.updates = 0
+    self.next_target = 0
+    self.reset()
+
+  def reset(self):
+    # counters for statistics
+    self.num_updates = 0
+    self.num_waits = 0
+
+  def start(self, epoch):
+    assert self.thread is None
+    self.epoch = epoch
+    self.running = True
+    self.thread = threading.Thread(target = self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify_all()
+    self.thread.join()
+    self.thread = None
+    # acting continues with the latest weights
+    self.net.sync_acting_weights()
+    if self.error is not None:
+      raise self.error
+
+  def addStep(self):
+    # called by agent after each environment step
+    if self.error is not None:
+      raise self.error
+    with self.condition:
+      self.steps += 1
+      self.condition.notify_all()
+      if self.mem.count > self.mem.batch_size and self.replay_ratio * self.steps - self.updates > self.max_lag:
+        self.num_waits += 1
+        while self.running and self.error is None and self.replay_ratio * self.steps - self.updates > self.max_lag:
+          self.condition.wait()
+
+  def _ready(self):
+    return self.updates < self.replay_ratio * self.steps and self.mem.count > self.mem.batch_size
+
+  def _run(self):
+    # GPU context must be current in every thread that uses it
+    ctx = getattr(self.net.be, 'ctx', None) if hasattr(self.net, 'be') else None
+    if ctx is not None:
+      ctx.push()
+    last_sync = self.updates
+    try:
+      while True:
+        with self.condition:
+          while self.running and not self._ready():
+            self.condition.wait()
+          if not self.running:
+            break
+          steps = self.steps
+        # update target network every target_steps environment steps
+        if self.target_steps and steps >= self.next_target:
+          start = time.time()
+          self.net.update_target_network()
+          self.agent.timers.add('target_sync', start)
+          self.next_target = (steps // self.target_steps + 1) * self.target_steps
+        self.agent.learn(self.epoch)
+        with self.condition:
+          self.updates += self.train_repeat
+          self.num_updates += self.train_repeat
+          self.condition.notify_all()
+        if self.updates - last_sync >= self.acting_sync_updates:
+          self.net.sync_acting_weights()
+          last_sync = self.updates
+    except Exception as e:
+      logger.exception("Learner thread failed")
+      with self.condition:
+        self.error = e
+        self.condition.notify_all()
+    finally:
+      if ctx is not None:
+        ctx.pop()
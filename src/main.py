@@ -1,14 +1,15 @@
 import logging
 logging.basicConfig(format='%(asctime)s %(message)s')
 
-from environment import ALEEnvironment, GymEnvironment
-from replay_memory import ReplayMemory
-from deepqnetwork import DeepQNetwork
-from agent import Agent
+from environment import ALEEnvironment, GymEnvironment, SyntheticEnvironment, VectorEnvironment
+from replay_memory import ReplayMemory, PrioritizedReplayMemory, PartitionedReplayMemory
+from agent import Agent, VectorAgent
 from statistics import Statistics
 import random
 import argparse
+import copy
 import sys
+import numpy as np
 
 def str2bool(v):
   return v.lower() in ("yes", "true", "t", "1")
@@ -16,8 +17,8 @@ def str2bool(v):
 parser = argparse.ArgumentParser()
 
 envarg = parser.add_argument_group('Environment')
-envarg.add_argument("game", help="ROM bin file or env id such as Breakout-v0 if training with Open AI Gym.")
-envarg.add_argument("--environment", choices=["ale", "gym"], default="ale", help="Whether to train agent using ALE or OpenAI Gym.")
+envarg.add_argument("game", help="ROM bin file or env id such as Breakout-v0 if training with Open AI Gym, any name with synthetic environment.")
+envarg.add_argument("--environment", choices=["ale", "gym", "synthetic"], default="ale", help="Whether to train agent using ALE, OpenAI Gym or synthetic game that needs no ROM.")
 envarg.add_argument("--display_screen", type=str2bool, default=False, help="Display game screen during training and testing.")
 #envarg.add_argument("--sound", type=str2bool, default=False, help="Play (or record) sound.")
 envarg.add_argument("--frame_skip", type=int, default=4, help="How many times to repeat each chosen action.")
@@ -26,12 +27,32 @@ envarg.add_argument("--minimal_action_set", dest="minimal_action_set", type=str2
 envarg.add_argument("--color_averaging", type=str2bool, default=True, help="Perform color averaging with previous frame.")
 envarg.add_argument("--screen_width", type=int, default=84, help="Screen width after resize.")
 envarg.add_argument("--screen_height", type=int, default=84, help="Screen height after resize.")
+envarg.add_argument("--screen_crop", type=lambda s: tuple(int(x) for x in s.split(',')), help="Pixels to remove from top,bottom,left,right of screen before resize.")
+envarg.add_argument("--screen_interpolation", choices=['nearest', 'linear', 'area', 'cubic'], default='linear', help="Interpolation used for resizing screen.")
+envarg.add_argument("--frame_max_pool", type=str2bool, default=False, help="Skip frames outside ALE and take maximum over the last two frames, turn off color averaging then.")
+envarg.add_argument("--start_states", type=int, default=0, help="Size of pool of start states played with dummy actions by another emulator in background, 0 plays dummy actions after each restart.")
 envarg.add_argument("--record_screen_path", help="Record game screens under this path. Subfolder for each game is created.")
 envarg.add_argument("--record_sound_filename", help="Record game sound in this file.")
+envarg.add_argument("--num_envs", type=int, default=1, help="Number of ALE or synthetic environments stepped in lockstep, actions for all of them are predicted at once.")
+envarg.add_argument("--synthetic_actions", type=int, default=6, help="Number of actions in synthetic environment.")
+envarg.add_argument("--synthetic_episode_length", type=int, default=1000, help="Number of steps in synthetic environment episode.")
+envarg.add_argument("--synthetic_reward_prob", type=float, default=0.01, help="Probability of non-zero reward in synthetic environment.")
+envarg.add_argument("--synthetic_step_cost", type=float, default=0, help="Seconds to sleep in each synthetic environment step, simulates emulation time.")
+envarg.add_argument("--synthetic_screen_width", type=int, default=160, help="Synthetic environment screen width before resize.")
+envarg.add_argument("--synthetic_screen_height", type=int, default=210, help="Synthetic environment screen height before resize.")
 
 memarg = parser.add_argument_group('Replay memory')
 memarg.add_argument("--replay_size", type=int, default=1000000, help="Maximum size of replay memory.")
 memarg.add_argument("--history_length", type=int, default=4, help="How many screen frames form a state.")
+memarg.add_argument("--replay_storage", choices=["memory", "memmap", "compressed"], default="memory", help="Keep replay memory screens in RAM, in memory-mapped file, which allows replay memory larger than RAM, or compressed in RAM.")
+memarg.add_argument("--replay_file", help="File for memory-mapped replay memory screens, temporary file by default.")
+memarg.add_argument("--replay_chunk_size", type=int, default=4, help="How many consecutive screens are compressed together with compressed replay storage.")
+memarg.add_argument("--replay_cache_chunks", type=int, default=256, help="How many decompressed chunks to cache with compressed replay storage.")
+memarg.add_argument("--prioritized_replay", type=str2bool, default=False, help="Sample transitions proportionally to their TD error.")
+memarg.add_argument("--priority_alpha", type=float, default=0.6, help="How much prioritization is used, 0 means uniform sampling.")
+memarg.add_argument("--priority_beta", type=float, default=0.4, help="How much importance sampling weights compensate for prioritization, 1 means full compensation.")
+memarg.add_argument("--n_step", type=int, default=1, help="Train on n-step returns, which replay memory accumulates while transitions are added.")
+memarg.add_argument("--priority_epsilon", type=float, default=1e-6, help="Small constant added to priorities, so that no transition has zero probability.")
 
 netarg = parser.add_argument_group('Deep Q-learning network')
 netarg.add_argument("--learning_rate", type=float, default=0.00025, help="Learning rate.")
@@ -43,12 +64,14 @@ netarg.add_argument("--clip_error", type=float, default=1, help="Clip error term
 netarg.add_argument("--min_reward", type=float, default=-1, help="Minimum reward.")
 netarg.add_argument("--max_reward", type=float, default=1, help="Maximum reward.")
 netarg.add_argument("--batch_norm", type=str2bool, default=False, help="Use batch normalization in all layers.")
+netarg.add_argument("--device_history", type=str2bool, default=False, help="Keep frame history for acting in backend memory and upload only the newest frame every step.")
+netarg.add_argument("--inference_batch_size", type=int, default=1, help="Batch size of separate model for predicting actions, which shares weights with training model. 0 uses training model.")
 
 #netarg.add_argument("--rescale_r", type=str2bool, help="Rescale rewards.")
 #missing: bufferSize=512,valid_size=500,min_reward=-1,max_reward=1
 
 neonarg = parser.add_argument_group('Neon')
-neonarg.add_argument('--backend', choices=['cpu', 'gpu'], default='gpu', help='backend type')
+neonarg.add_argument('--backend', choices=['cpu', 'gpu', 'numpy'], default='gpu', help='backend type, numpy uses NumPy implementation instead of Neon')
 neonarg.add_argument('--device_id', type=int, default=0, help='gpu device id (only used with GPU backend)')
 neonarg.add_argument('--datatype', choices=['float16', 'float32', 'float64'], default='float32', help='default floating point precision for backend [f64 for cpu only]')
 neonarg.add_argument('--stochastic_round', const=True, type=int, nargs='?', default=False, help='use stochastic rounding [will round to BITS number of bits if specified]')
@@ -60,9 +83,22 @@ antarg.add_argument("--exploration_decay_steps", type=float, default=1000000, he
 antarg.add_argument("--exploration_rate_test", type=float, default=0.05, help="Exploration rate used during testing.")
 antarg.add_argument("--train_frequency", type=int, default=4, help="Perform training after this many game steps.")
 antarg.add_argument("--train_repeat", type=int, default=1, help="Number of times to sample minibatch during training.")
+antarg.add_argument("--prefetch_minibatches", type=int, default=0, help="Prepare this many minibatches in background thread while network is trained, 0 disables prefetching.")
+antarg.add_argument("--learner_thread", type=str2bool, default=False, help="Train network in background thread while acting.")
+antarg.add_argument("--replay_ratio", type=float, default=0, help="Minibatch updates per environment step with learner thread, 0 means train_repeat / train_frequency.")
+antarg.add_argument("--learner_max_lag", type=int, default=100, help="Acting waits when learner thread is this many minibatch updates behind.")
+antarg.add_argument("--acting_sync_updates", type=int, default=100, help="Copy weights used for acting after this many minibatch updates in learner thread.")
 antarg.add_argument("--target_steps", type=int, default=10000, help="Copy main network to target network after this many game steps.")
+antarg.add_argument("--target_update_tau", type=float, default=0, help="Move target network towards main network by this fraction after every training step, 0 disables. Use with --target_steps 0 for soft updates only.")
 antarg.add_argument("--random_starts", type=int, default=30, help="Perform max this number of dummy actions after game restart, to produce more random game dynamics.")
 
+actorarg = parser.add_argument_group('Actors')
+actorarg.add_argument("--actors", type=int, default=0, help="Number of actor processes filling shared replay memory while main process only learns, 0 acts in main process.")
+actorarg.add_argument("--actor_backend", choices=['cpu', 'gpu'], default='cpu', help="Neon backend used by actor processes for predicting actions.")
+actorarg.add_argument("--actor_exploration_rate", type=float, default=0.4, help="Base exploration rate of actors, actor i uses base ** (1 + alpha * i / (actors - 1)).")
+actorarg.add_argument("--actor_exploration_alpha", type=float, default=7, help="Exponent for spreading exploration rates of actors.")
+actorarg.add_argument("--publish_steps", type=int, default=100, help="Publish learner weights to actors after this many minibatch updates.")
+
 nvisarg = parser.add_argument_group('Visualization')
 nvisarg.add_argument("--visualization_filters", type=int, default=4, help="Number of filters to visualize from each convolutional layer.")
 nvisarg.add_argument("--visualization_file", help="Write layer visualization to this file.")
@@ -75,8 +111,21 @@ mainarg.add_argument("--epochs", type=int, default=200, help="How many epochs to
 mainarg.add_argument("--start_epoch", type=int, default=0, help="Start from this epoch, affects exploration rate and names of saved snapshots.")
 mainarg.add_argument("--play_games", type=int, default=0, help="How many games to play, suppresses training and testing.")
 mainarg.add_argument("--load_weights", help="Load network from file.")
+mainarg.add_argument("--export_model", help="Export network for NumPy inference to given .npz file and exit.")
+mainarg.add_argument("--load_model", help="Play or test with network exported by --export_model, Neon is not needed.")
+mainarg.add_argument("--quantize", type=str2bool, default=False, help="Play and test with network quantized to 8-bit integers on CPU.")
+mainarg.add_argument("--quantize_states", type=int, default=1000, help="Number of replay memory states used to calibrate quantization and to measure its agreement with the original network.")
 mainarg.add_argument("--save_weights_prefix", help="Save network to given file. Epoch and extension will be appended.")
+mainarg.add_argument("--save_weights_keep_last", type=int, default=0, help="Keep only weights of this many last epochs, 0 keeps all.")
+mainarg.add_argument("--save_weights_keep_best", type=int, default=0, help="Keep also weights of this many epochs with best test reward, used only with --save_weights_keep_last.")
+mainarg.add_argument("--validation_states", type=int, default=1000, help="Number of replay memory states used to measure Q-values after each phase.")
 mainarg.add_argument("--csv_file", help="Write training progress to this file.")
+mainarg.add_argument("--export_dataset", help="Export replay memory contents to this folder at the end.")
+mainarg.add_argument("--export_chunk_size", type=int, default=10000, help="Number of transitions in one exported dataset file.")
+mainarg.add_argument("--offline_dataset", help="Train from dataset in this folder instead of playing the game. Environment is used only for testing.")
+mainarg.add_argument("--checkpoint_dir", help="Save full training state including replay memory to this folder after each epoch.")
+mainarg.add_argument("--resume", type=str2bool, default=False, help="Resume training from checkpoint in --checkpoint_dir.")
+mainarg.add_argument("--checkpoint_chunk_size", type=int, default=10000, help="Number of replay memory screens written or read at once in checkpoints.")
 
 comarg = parser.add_argument_group('Common')
 comarg.add_argument("--random_seed", type=int, help="Random seed for repeatable experiments.")
@@ -88,27 +137,145 @@ logger.setLevel(args.log_level)
 
 if args.random_seed:
   random.seed(args.random_seed)
+  np.random.seed(args.random_seed)
 
 # instantiate classes
-if args.environment == 'ale':
+if args.offline_dataset and not args.test_steps:
+  # offline training doesn't need emulator at all
+  env = None
+elif args.environment in ['ale', 'synthetic'] and args.num_envs > 1:
+  envs = []
+  for i in xrange(args.num_envs):
+    env_args = copy.copy(args)
+    if args.random_seed:
+      env_args.random_seed += i
+    if i > 0:
+      # only first environment is displayed and recorded
+      env_args.display_screen = False
+      env_args.record_screen_path = None
+      env_args.record_sound_filename = None
+    if args.environment == 'ale':
+      envs.append(ALEEnvironment(args.game, env_args))
+    else:
+      envs.append(SyntheticEnvironment(env_args))
+  env = VectorEnvironment(envs)
+  logger.info("Using %d %s Environments" % (args.num_envs, "ALE" if args.environment == 'ale' else "Synthetic"))
+elif args.environment == 'ale':
   env = ALEEnvironment(args.game, args)
   logger.info("Using ALE Environment")
 elif args.environment == 'gym':
   logger.handlers.pop()
   env = GymEnvironment(args.game, args)
   logger.info("Using Gym Environment")
+elif args.environment == 'synthetic':
+  env = SyntheticEnvironment(args)
+  logger.info("Using Synthetic Environment")
 else:
   assert False, "Unknown environment" + args.environment
 
-mem = ReplayMemory(args.replay_size, args)
-net = DeepQNetwork(env.numActions(), args)
-agent = Agent(env, mem, net, args)
+if args.offline_dataset:
+  assert not args.actors and not args.play_games, "Offline dataset can be used only for training"
+  import dataset
+  dataset_info = dataset.read_info(args.offline_dataset)
+  num_actions = dataset_info['num_actions']
+  assert env is None or env.numActions() == num_actions, "Dataset was recorded with different number of actions"
+  logger.info("Training from dataset %s with %d transitions" % (args.offline_dataset, dataset_info['num_transitions']))
+  transitions = dataset.read_transitions(args.offline_dataset)
+else:
+  num_actions = env.numActions()
+
+if args.actors:
+  assert not args.play_games, "Actors can't be used for playing games"
+  assert not args.learner_thread, "Actors already train in separate process from acting"
+  assert not args.export_dataset, "Dataset export is not supported with actors, replay memory is split into partitions"
+  from actors import ActorPool
+  pool = ActorPool(args)
+  mem = pool.mem
+  # fork actors before learner creates Neon backend
+  pool.start()
+elif args.num_envs > 1:
+  assert args.environment in ['ale', 'synthetic'], "Several environments are supported only with ALE and synthetic environment"
+  assert not (args.offline_dataset or args.play_games or args.prioritized_replay or args.checkpoint_dir or args.export_dataset or args.quantize), \
+      "Several environments can't be used with offline dataset, playing games, prioritized replay, checkpoints, dataset export or quantization"
+  # separate partition for each environment, so that histories don't mix
+  partitions = []
+  for i in xrange(args.num_envs):
+    partition_args = copy.copy(args)
+    if args.replay_file:
+      partition_args.replay_file = "%s.%d" % (args.replay_file, i)
+    partitions.append(ReplayMemory(args.replay_size // args.num_envs, partition_args))
+  mem = PartitionedReplayMemory(partitions, args)
+elif args.prioritized_replay:
+  mem = PrioritizedReplayMemory(args.replay_size, args)
+else:
+  mem = ReplayMemory(args.replay_size, args)
+if args.load_model:
+  assert not args.train_steps, "Exported network can be used only for playing and testing"
+  assert not args.device_history, "Exported network doesn't support device history"
+  from numpy_network import NumpyNetwork
+  net = NumpyNetwork(args.load_model)
+  assert net.num_actions == num_actions, "Network was exported for different number of actions"
+elif args.backend == 'numpy':
+  assert not args.actors, "Actors are not supported with NumPy backend"
+  assert not args.checkpoint_dir, "Checkpoints are not supported with NumPy backend"
+  from numpy_deepqnetwork import NumpyDeepQNetwork
+  net = NumpyDeepQNetwork(num_actions, args)
+else:
+  # import Neon only when needed
+  from deepqnetwork import DeepQNetwork
+  net = DeepQNetwork(num_actions, args)
+if args.num_envs > 1:
+  agent = VectorAgent(env, mem, net, args)
+else:
+  agent = Agent(env, mem, net, args)
 stats = Statistics(agent, net, mem, env, args)
 
 if args.load_weights:
   logger.info("Loading weights from %s" % args.load_weights)
   net.load_weights(args.load_weights)
 
+if args.checkpoint_dir:
+  assert not args.actors, "Checkpoints are not supported with actors"
+  from checkpoint import Checkpoint
+  checkpoint = Checkpoint(args.checkpoint_dir, args)
+  if args.resume:
+    args.start_epoch = checkpoint.load(agent)
+    # replay memory is restored, no need to populate it
+    args.random_steps = 0
+
+if args.export_model:
+  from numpy_network import NumpyNetwork, export_model, check_parity
+  export_model(net, args.export_model)
+  # check that exported network gives the same Q-values
+  states = np.random.randint(256, size = (net.batch_size, args.history_length, args.screen_height, args.screen_width)).astype(np.uint8)
+  error = check_parity(net, NumpyNetwork(args.export_model), states)
+  logger.info("Maximum Q-value difference of exported network: %g" % error)
+  sys.exit()
+
+if args.quantize:
+  assert not args.train_steps, "Quantized network can be used only for playing and testing"
+  assert not args.device_history, "Quantized network doesn't support device history"
+  from quantization import QuantizedNetwork, calibration_states
+  states = calibration_states(agent, args)
+  # calibrate on half of the states, measure agreement on the other half
+  quantized_net = QuantizedNetwork(net, states[::2])
+  agreement, error = quantized_net.agreement(net, states[1::2])
+  logger.info("Quantized network chooses the same action in %.1f%% of states, maximum Q-value error %f" % (agreement * 100, error))
+  agent.net = quantized_net
+
+if args.save_weights_prefix:
+  from checkpoint import WeightWriter
+  weight_writer = WeightWriter(args)
+
+if args.actors:
+  # actors start acting when they receive initial weights
+  pool.publish(net)
+
+def export_dataset():
+  if args.export_dataset:
+    import dataset
+    dataset.export_dataset(mem, args.export_dataset, num_actions, args.export_chunk_size)
+
 if args.play_games:
   logger.info("Playing for %d game(s)" % args.play_games)
   # Set env mode test so that loss of life is not considered as terminal
@@ -121,13 +288,20 @@ if args.play_games:
     # use states recorded during gameplay. NB! Check buffer size, that it can accomodate one game!
     states = [agent.mem.getState(i) for i in xrange(agent.history_length, agent.mem.current - agent.random_starts)]
     logger.info("Collected %d game states" % len(states))
-    import numpy as np
     states = np.array(states)
     states = states / 255.
     visualize(net.model, states, args.visualization_filters, args.visualization_file)
+  export_dataset()
   sys.exit()
 
-if args.random_steps:
+if args.random_steps and args.actors:
+  # actors populate replay memory using their own exploration rates
+  pool.waitForSteps(args.random_steps)
+elif args.random_steps and args.offline_dataset:
+  logger.info("Populating replay memory with %d transitions from dataset" % args.random_steps)
+  for i in xrange(args.random_steps):
+    mem.add(*next(transitions))
+elif args.random_steps:
   # populate replay memory with random steps
   logger.info("Populating replay memory with %d random moves" % args.random_steps)
   # Set env mode test so that loss of life is considered as terminal
@@ -142,17 +316,19 @@ for epoch in xrange(args.start_epoch, args.epochs):
 
   if args.train_steps:
     logger.info(" Training for %d steps" % args.train_steps)
-    # Set env mode test so that loss of life is considered as terminal
-    env.setMode('train')
     stats.reset()
-    agent.train(args.train_steps, epoch)
+    if args.offline_dataset:
+      agent.train_offline(transitions, args.train_steps, epoch)
+    else:
+      # Set env mode test so that loss of life is considered as terminal
+      env.setMode('train')
+      if args.actors:
+        pool.train(agent, args.train_steps, epoch)
+      else:
+        agent.train(args.train_steps, epoch)
     stats.write(epoch + 1, "train")
 
-    if args.save_weights_prefix:
-      filename = args.save_weights_prefix + "_%d.prm" % (epoch + 1)
-      logger.info("Saving weights to %s" % filename)
-      net.save_weights(filename)
-
+  score = None
   if args.test_steps:
     logger.info(" Testing for %d steps" % args.test_steps)
     # Set env mode test so that loss of life is not considered as terminal
@@ -160,6 +336,23 @@ for epoch in xrange(args.start_epoch, args.epochs):
     stats.reset()
     agent.test(args.test_steps, epoch)
     stats.write(epoch + 1, "test")
+    score = stats.average_reward
+
+  # testing doesn't change weights, save them with test reward for retention
+  if args.train_steps and args.save_weights_prefix:
+    filename = args.save_weights_prefix + "_%d.prm" % (epoch + 1)
+    logger.info("Saving weights to %s" % filename)
+    weight_writer.save(net, filename, score)
+
+  if args.checkpoint_dir:
+    checkpoint.save(agent, epoch + 1)
 
+export_dataset()
+if args.checkpoint_dir:
+  checkpoint.wait()
+if args.save_weights_prefix:
+  weight_writer.close()
 stats.close()
+if args.actors:
+  pool.stop()
 logger.info("All done")
@@ -0,0 +1,422 @@
+import numpy as np
+import time
+import threading
+from numpy_network import im2col, col2im
+from timers import Timers
+import logging
+logger = logging.getLogger(__name__)
+
+class NumpyDeepQNetwork:
+  """
+  Same network, cost and optimizers as DeepQNetwork, implemented with NumPy
+  for machines without GPU. Convolutions are done with im2col and matrix
+  multiplication in channels last order, all buffers are allocated once
+  per batch size. Layers have no biases, just like in DeepQNetwork.
+  """
+  def __init__(self, num_actions, args):
+    # remember parameters
+    self.num_actions = num_actions
+    self.batch_size = args.batch_size
+    self.n_step = args.n_step
+    # n-step returns are bootstrapped from the state n steps later
+    self.discount_rate = args.discount_rate ** args.n_step
+    self.history_length = args.history_length
+    self.screen_dim = (args.screen_height, args.screen_width)
+    self.clip_error = args.clip_error
+    self.min_reward = args.min_reward
+    self.max_reward = args.max_reward
+    self.dtype = np.dtype(args.datatype)
+    assert not args.batch_norm, "NumPy backend doesn't support batch normalization"
+    assert not args.device_history, "NumPy backend doesn't support device history"
+    self.rng = np.random.RandomState(args.random_seed or None)
+
+    # same layers as in DeepQNetwork._createLayers(), as [W, b, relu, conv]
+    self.layers = []
+    C, H, W = (self.history_length,) + self.screen_dim
+    for R, K, stride in ((8, 32, 4), (4, 64, 2), (3, 64, 1)):
+      self.layers.append([self._xavier(R * R * C, K), np.zeros(K, dtype = self.dtype), True, (R, R, stride)])
+      C, H, W = K, (H - R) // stride + 1, (W - R) // stride + 1
+    self.layers.append([self._xavier(C * H * W, 512), np.zeros(512, dtype = self.dtype), True, None])
+    self.layers.append([self._xavier(512, num_actions), np.zeros(num_actions, dtype = self.dtype), False, None])
+    self.params = [layer[0] for layer in self.layers]
+    self.grads = [np.empty_like(param) for param in self.params]
+
+    self.optimizer = args.optimizer
+    self.learning_rate = args.learning_rate
+    self.decay_rate = args.decay_rate
+    # optimizer states, same defaults as in Neon
+    if self.optimizer == 'rmsprop':
+      self.epsilon = 1e-6
+      self.states = [[np.zeros_like(param)] for param in self.params]
+    elif self.optimizer == 'adam':
+      self.beta_1, self.beta_2, self.epsilon = 0.9, 0.999, 1e-8
+      self.adam_steps = 0
+      self.states = [[np.zeros_like(param), np.zeros_like(param)] for param in self.params]
+    elif self.optimizer == 'adadelta':
+      self.epsilon = 1e-6
+      self.states = [[np.zeros_like(param), np.zeros_like(param), np.zeros_like(param)] for param in self.params]
+    else:
+      assert False, "Unknown optimizer"
+    self.temp = [np.empty_like(param) for param in self.params]
+
+    # create target network
+    self.train_iterations = 0
+    self.target_update_tau = args.target_update_tau
+    if args.target_steps or self.target_update_tau:
+      self.target_params = [param.copy() for param in self.params]
+    else:
+      self.target_params = self.params
+
+    # with learner thread acting uses its own copy of weights and workspaces
+    self.acting_lock = threading.Lock()
+    if args.learner_thread:
+      self.acting_params = [param.copy() for param in self.params]
+      self.acting_workspaces = {}
+    else:
+      self.acting_params = self.params
+
+    # workspaces for each batch size, created on first use
+    self.workspaces = {}
+    self.deltas = np.empty((self.batch_size, self.num_actions), dtype = self.dtype)
+    self.batch_indexes = np.arange(self.batch_size)
+
+    self.callback = None
+    # wall-clock time of training phases
+    self.timers = Timers(['forward', 'backward'])
+
+  def _xavier(self, fan_in, fan_out):
+    # same as Neon Xavier initialization
+    scale = np.sqrt(3. / fan_in)
+    return self.rng.uniform(-scale, scale, (fan_in, fan_out)).astype(self.dtype)
+
+  def _workspace(self, batch_size, workspaces = None):
+    if workspaces is None:
+      workspaces = self.workspaces
+    if batch_size not in workspaces:
+      C, H, W = (self.history_length,) + self.screen_dim
+      input = np.empty((batch_size, H, W, C), dtype = self.dtype)
+      # (input shape, cols, output) for each layer, cols is None for affine layers
+      layers = []
+      for param, b, relu, conv in self.layers:
+        if conv:
+          shape = (batch_size, H, W, C)
+          R, S, stride = conv
+          H, W, C = (H - R) // stride + 1, (W - S) // stride + 1, param.shape[1]
+          cols = np.empty((batch_size * H * W, param.shape[0]), dtype = self.dtype)
+          output = np.empty((batch_size * H * W, param.shape[1]), dtype = self.dtype)
+        else:
+          shape = (batch_size, param.shape[0])
+          cols = None
+          output = np.empty((batch_size, param.shape[1]), dtype = self.dtype)
+        layers.append((shape, cols, output))
+      workspaces[batch_size] = (input, layers)
+    return workspaces[batch_size]
+
+  def _forward(self, states, params, workspaces = None):
+    # returns Q-values in workspace, valid until next forward pass
+    input, layers = self._workspace(states.shape[0], workspaces)
+    # change order of axes to channels last and normalize between 0 and 1
+    np.multiply(states.transpose((0, 2, 3, 1)), 1 / 255., out = input, casting = 'unsafe')
+    x = input
+    for param, (_, b, relu, conv), (shape, cols, output) in zip(params, self.layers, layers):
+      if conv:
+        R, S, stride = conv
+        im2col(x.reshape(shape), R, S, stride, cols)
+        x = cols
+      else:
+        x = x.reshape(shape)
+      np.dot(x, param, out = output)
+      if relu:
+        np.maximum(output, 0, output)
+      x = output
+    return output
+
+  def _backward(self, deltas):
+    # gradients of main network parameters, uses last forward pass
+    input, layers = self._workspace(deltas.shape[0])
+    if 'backward' not in self.workspaces:
+      # gradients of layer inputs, not needed for first layer
+      self.workspaces['backward'] = [None] + [(None if cols is None else np.empty_like(cols), np.empty(shape, dtype = self.dtype))
+          for shape, cols, output in layers[1:]]
+    backward = self.workspaces['backward']
+    dy = deltas
+    for i in reversed(xrange(len(self.layers))):
+      param, b, relu, conv = self.layers[i]
+      shape, cols, output = layers[i]
+      if relu:
+        dy *= output > 0
+      # input of layer is im2col matrix or output of previous layer
+      x = cols if conv else layers[i - 1][2].reshape(shape)
+      np.dot(x.T, dy, out = self.grads[i])
+      if i == 0:
+        break
+      dcols, dx = backward[i]
+      if conv:
+        np.dot(dy, param.T, out = dcols)
+        R, S, stride = conv
+        col2im(dcols, shape, R, S, stride, dx)
+      else:
+        np.dot(dy, param.T, out = dx)
+      # gradient of previous layer output
+      dy = dx.reshape(layers[i - 1][2].shape)
+
+  def _optimize(self):
+    # same updates as Neon optimizers, gradients are averaged over minibatch
+    if self.optimizer == 'adam':
+      self.adam_steps += 1
+      lrate = self.learning_rate * np.sqrt(1 - self.beta_2 ** self.adam_steps) / (1 - self.beta_1 ** self.adam_steps)
+    for param, grad, states, temp in zip(self.params, self.grads, self.states, self.temp):
+      grad /= self.batch_size
+      if self.optimizer == 'rmsprop':
+        state, = states
+        state *= self.decay_rate
+        np.multiply(grad, grad, temp)
+        temp *= 1 - self.decay_rate
+        state += temp
+        # param -= lrate * grad / (sqrt(state + eps) + eps)
+        np.add(state, self.epsilon, temp)
+        np.sqrt(temp, temp)
+        temp += self.epsilon
+        np.divide(grad, temp, temp)
+        temp *= self.learning_rate
+        param -= temp
+      elif self.optimizer == 'adam':
+        m, v = states
+        m *= self.beta_1
+        np.multiply(grad, 1 - self.beta_1, temp)
+        m += temp
+        v *= self.beta_2
+        np.multiply(grad, grad, temp)
+        temp *= 1 - self.beta_2
+        v += temp
+        # param -= lrate * m / (sqrt(v) + eps)
+        np.sqrt(v, temp)
+        temp += self.epsilon
+        np.divide(m, temp, temp)
+        temp *= lrate
+        param -= temp
+      else:
+        grad2, dx2, dx = states
+        grad2 *= self.decay_rate
+        np.multiply(grad, grad, temp)
+        temp *= 1 - self.decay_rate
+        grad2 += temp
+        # dx = -sqrt((dx2 + eps) / (grad2 + eps)) * grad
+        np.add(dx2, self.epsilon, dx)
+        np.add(grad2, self.epsilon, temp)
+        dx /= temp
+        np.sqrt(dx, dx)
+        dx *= grad
+        dx2 *= self.decay_rate
+        np.multiply(dx, dx, temp)
+        temp *= 1 - self.decay_rate
+        dx2 += temp
+        param -= dx
+
+  def sync_acting_weights(self):
+    # copy weights used for acting, learner thread calls this between updates
+    if self.acting_params is not self.params:
+      with self.acting_lock:
+        for src, dst in zip(self.params, self.acting_params):
+          np.copyto(dst, src)
+
+  def update_target_network(self):
+    for src, dst in zip(self.params, self.target_params):
+      np.copyto(dst, src)
+
+  def _softUpdateTargetNetwork(self):
+    # move target network slowly towards main network
+    for src, dst in zip(self.params, self.target_params):
+      dst *= 1 - self.target_update_tau
+      dst += self.target_update_tau * src
+
+  def train(self, minibatch, epoch, weights = None):
+    # expand components of minibatch
+    prestates, actions, rewards, poststates, terminals = minibatch
+    assert len(prestates.shape) == 4
+    assert len(poststates.shape) == 4
+    assert prestates.shape == poststates.shape
+    assert prestates.shape[0] == actions.shape[0] == rewards.shape[0] == poststates.shape[0] == terminals.shape[0] == self.batch_size
+    start = time.time()
+
+    # calculate max Q-value for each poststate
+    maxpostq = self._forward(poststates, self.target_params).max(axis = 1)
+
+    # feed-forward pass for prestates
+    preq = self._forward(prestates, self.params)
+
+    # clip rewards between -1 and 1,
+    # n-step returns are sums of rewards clipped by replay memory
+    if self.n_step == 1:
+      rewards = np.clip(rewards, self.min_reward, self.max_reward)
+
+    # Q-value targets for actions taken
+    targets = rewards + self.discount_rate * maxpostq * ~terminals.astype(bool)
+
+    # TD errors of actions taken, used for replay priorities
+    errors = targets - preq[self.batch_indexes, actions]
+
+    # SumSquared cost has non-zero errors only for actions taken
+    self.deltas[...] = 0
+    self.deltas[self.batch_indexes, actions] = -errors
+    cost = 0.5 * np.mean(errors ** 2)
+    start = self.timers.add('forward', start)
+
+    # clip errors
+    if self.clip_error:
+      np.clip(self.deltas, -self.clip_error, self.clip_error, out = self.deltas)
+
+    # scale errors with importance sampling weights
+    if weights is not None:
+      self.deltas *= weights[:, np.newaxis]
+
+    # perform back-propagation of gradients and optimization
+    self._backward(self.deltas)
+    self._optimize()
+
+    # soft update of target network after every weight update
+    if self.target_update_tau:
+      self._softUpdateTargetNetwork()
+
+    # increase number of weight updates (needed for stats callback)
+    self.train_iterations += 1
+
+    # calculate statistics
+    if self.callback:
+      self.callback.on_train(cost)
+    self.timers.add('backward', start)
+
+    return errors
+
+  def predict(self, states):
+    assert states.shape[1:] == ((self.history_length,) + self.screen_dim)
+    if self.acting_params is self.params:
+      qvalues = self._forward(states, self.params).copy()
+    else:
+      with self.acting_lock:
+        qvalues = self._forward(states, self.acting_params, self.acting_workspaces).copy()
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug("Q-values: " + str(qvalues[0]))
+    return qvalues
+
+  def _arrays(self):
+    arrays = {}
+    for i, param in enumerate(self.params):
+      arrays['W%d' % i] = param
+      arrays['target%d' % i] = self.target_params[i]
+      for j, state in enumerate(self.states[i]):
+        arrays['state%d_%d' % (i, j)] = state
+    if self.optimizer == 'adam':
+      arrays['adam_steps'] = self.adam_steps
+    return arrays
+
+  def get_weights(self):
+    # copy of parameters and optimizer states, used by WeightWriter
+    return dict((name, np.copy(array)) for name, array in self._arrays().items())
+
+  def write_weights(self, weights, save_path):
+    with open(save_path, 'wb') as f:
+      np.savez(f, **weights)
+
+  def load_weights(self, load_path):
+    with np.load(load_path) as f:
+      for name, array in self._arrays().items():
+        if name == 'adam_steps':
+          self.adam_steps = int(f[name])
+        else:
+          array[...] = f[name]
+    self.sync_acting_weights()
+    # target network starts from loaded weights, not random initialization
+    self.update_target_network()
+
+  def save_weights(self, save_path):
+    self.write_weights(self._arrays(), save_path)
+
+if __name__ == '__main__':
+  import argparse
+  import time
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--screen_width", type=int, default=84, help="Screen width after resize.")
+  parser.add_argument("--screen_height", type=int, default=84, help="Screen height after resize.")
+  parser.add_argument("--history_length", type=int, default=4, help="How many screen frames form a state.")
+  parser.add_argument("--num_actions", type=int, default=6, help="Number of actions.")
+  parser.add_argument("--batch_size", type=int, default=32, help="Batch size for neural network.")
+  parser.add_argument('--optimizer', choices=['rmsprop', 'adam', 'adadelta'], default='rmsprop', help='Network optimization algorithm.')
+  parser.add_argument("--learning_rate", type=float, default=0.00025, help="Learning rate.")
+  parser.add_argument("--decay_rate", type=float, default=0.95, help="Decay rate for RMSProp and Adadelta algorithms.")
+  parser.add_argument("--discount_rate", type=float, default=0.99, help="Discount rate for future rewards.")
+  parser.add_argument("--clip_error", type=float, default=1, help="Clip error term in update between this number and its negative.")
+  parser.add_argument('--datatype', choices=['float32', 'float64'], default='float32', help='Floating point precision for benchmark.')
+  parser.add_argument("--train_steps", type=int, default=20, help="Number of minibatch updates to benchmark.")
+  parser.add_argument("--gradient_checks", type=int, default=10, help="Number of checked parameters per layer.")
+  parser.add_argument("--neon", action="store_true", help="Benchmark also Neon CPU backend.")
+  parser.add_argument("--random_seed", type=int, default=1, help="Random seed.")
+  args = parser.parse_args()
+  # network arguments not relevant for benchmark
+  args.n_step = 1
+  args.min_reward = -1
+  args.max_reward = 1
+  args.batch_norm = False
+  args.device_history = False
+  args.learner_thread = False
+  args.target_steps = 10000
+  args.target_update_tau = 0
+  args.backend = 'cpu'
+  args.device_id = 0
+  args.stochastic_round = False
+  args.inference_batch_size = 1
+  args.save_weights_prefix = None
+
+  def minibatch():
+    shape = (args.batch_size, args.history_length, args.screen_height, args.screen_width)
+    return (np.random.randint(256, size = shape).astype(np.uint8),
+        np.random.randint(args.num_actions, size = args.batch_size),
+        np.random.uniform(-1, 1, size = args.batch_size),
+        np.random.randint(256, size = shape).astype(np.uint8),
+        np.random.random(args.batch_size) < 0.1)
+
+  # compare gradients with finite differences in double precision,
+  # small step keeps rectifiers from switching on or off
+  step = 1e-7
+  check_args = argparse.Namespace(**vars(args))
+  check_args.datatype = 'float64'
+  net = NumpyDeepQNetwork(args.num_actions, check_args)
+  states, actions, targets = minibatch()[:3]
+  def loss():
+    qvalues = net._forward(states, net.params)
+    return 0.5 * np.sum((qvalues[net.batch_indexes, actions] - targets) ** 2)
+  qvalues = net._forward(states, net.params)
+  deltas = np.zeros_like(qvalues)
+  deltas[net.batch_indexes, actions] = qvalues[net.batch_indexes, actions] - targets
+  net._backward(deltas)
+  for i, (param, grad) in enumerate(zip(net.params, net.grads)):
+    errors = []
+    for j in np.random.choice(param.size, args.gradient_checks, replace = False):
+      index = np.unravel_index(j, param.shape)
+      value = param[index]
+      param[index] = value + step
+      plus = loss()
+      param[index] = value - step
+      minus = loss()
+      param[index] = value
+      numeric = (plus - minus) / (2 * step)
+      errors.append(abs(numeric - grad[index]) / max(abs(numeric) + abs(grad[index]), 1e-8))
+    print "Layer %d: maximum relative gradient error %g" % (i, max(errors))
+
+  # measure training throughput
+  batches = [minibatch() for i in xrange(args.train_steps)]
+  networks = [('NumPy', NumpyDeepQNetwork(args.num_actions, args))]
+  if args.neon:
+    from deepqnetwork import DeepQNetwork
+    networks.append(('Neon CPU', DeepQNetwork(args.num_actions, args)))
+  for name, net in networks:
+    net.train(batches[0], 0)
+    start = time.time()
+    for batch in batches:
+      net.train(batch, 0)
+    print "%s: %.1f minibatch updates per second" % (name, args.train_steps / (time.time() - start))
+    states = batches[0][0][:1]
+    start = time.time()
+    for i in xrange(args.train_steps):
+      net.predict(states)
+    print "%s: %.1f predictions per second" % (name, args.train_steps / (time.time() - start))
@@ -0,0 +1,189 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import logging
+logger = logging.getLogger(__name__)
+
+def im2col(x, R, S, stride, out = None):
+  # patches of NHWC input as rows, patch elements in R, S, C order
+  N, H, W, C = x.shape
+  P = (H - R) // stride + 1
+  Q = (W - S) // stride + 1
+  sN, sH, sW, sC = x.strides
+  patches = as_strided(x, shape = (N, P, Q, R, S, C), strides = (sN, sH * stride, sW * stride, sH, sW, sC))
+  if out is None:
+    return patches.reshape((N * P * Q, R * S * C)), P, Q
+  out.reshape((N, P, Q, R, S, C))[...] = patches
+  return out, P, Q
+
+def col2im(cols, shape, R, S, stride, out):
+  # sums patch gradients back to NHWC input gradient, inverse of im2col
+  N, H, W, C = shape
+  P = (H - R) // stride + 1
+  Q = (W - S) // stride + 1
+  cols = cols.reshape((N, P, Q, R, S, C))
+  out[...] = 0
+  for r in xrange(R):
+    for s in xrange(S):
+      out[:, r:r + stride * (P - 1) + 1:stride, s:s + stride * (Q - 1) + 1:stride] += cols[:, :, :, r, s]
+  return out
+
+def fold_layers(neon_layers):
+  """
+  Converts Neon layers to list of [W, b, relu, conv], where W has inputs in
+  channels last order as rows, batch normalization and bias are folded into
+  W and b, and conv is (R, S, stride) for convolutional layers and None for
+  affine layers.
+  """
+  layers = []
+  shape = None
+  for layer in neon_layers:
+    name = layer.__class__.__name__
+    if name == 'Convolution':
+      p = layer.convparams
+      assert p['pad_h'] == p['pad_w'] == 0 and p['str_h'] == p['str_w']
+      C = layer.in_shape[0]
+      R, S, K = layer.fshape
+      # Neon filters are in C, R, S, K order, im2col patches in R, S, C order
+      W = layer.W.asnumpyarray().reshape((C, R, S, K))
+      W = W.transpose((1, 2, 0, 3)).reshape((-1, K))
+      layers.append([W, np.zeros(K), False, (R, S, p['str_h'])])
+      # shape of output feature maps, needed to reorder following affine layer
+      shape = layer.out_shape
+    elif name == 'Linear':
+      W = layer.W.asnumpyarray()
+      if shape is not None:
+        # Neon flattens feature maps in K, P, Q order, here they are P, Q, K
+        W = W.reshape((W.shape[0],) + shape).transpose((0, 2, 3, 1)).reshape((W.shape[0], -1))
+      layers.append([W.T, np.zeros(W.shape[0]), False, None])
+      shape = None
+    elif name == 'Bias':
+      layers[-1][1] = layers[-1][1] + layer.W.asnumpyarray().ravel()
+    elif name == 'BatchNorm':
+      gamma = layer.gamma.asnumpyarray().ravel()
+      beta = layer.beta.asnumpyarray().ravel()
+      gmean = layer.gmean.asnumpyarray().ravel()
+      gvar = layer.gvar.asnumpyarray().ravel()
+      scale = gamma / np.sqrt(gvar + layer.eps)
+      layers[-1][0] = layers[-1][0] * scale
+      layers[-1][1] = (layers[-1][1] - gmean) * scale + beta
+    elif name == 'Activation':
+      assert layer.transform.__class__.__name__ == 'Rectlin'
+      layers[-1][2] = True
+    else:
+      assert False, "Unsupported layer " + name
+  return [[W.astype(np.float32), b.astype(np.float32), relu, conv] for W, b, relu, conv in layers]
+
+def network_layers(net):
+  # folded layers of DeepQNetwork, NumpyDeepQNetwork or NumpyNetwork
+  if hasattr(net, 'layers'):
+    return net.layers
+  return fold_layers(net.model.layers.layers)
+
+def export_model(net, path):
+  # write folded layers of network to .npz file
+  logger.info("Exporting network to %s" % path)
+  arrays = {
+    'num_actions': net.num_actions,
+    'input_shape': (net.history_length,) + net.screen_dim,
+  }
+  for i, (W, b, relu, conv) in enumerate(network_layers(net)):
+    arrays['W%d' % i] = W
+    arrays['b%d' % i] = b
+    arrays['relu%d' % i] = relu
+    arrays['conv%d' % i] = conv if conv else ()
+  with open(path, 'wb') as f:
+    np.savez(f, **arrays)
+
+def check_parity(net, engine, states):
+  # maximum difference of Q-values between two networks
+  qvalues = np.vstack([net.predict(states[i:i + net.batch_size]) for i in xrange(0, len(states), net.batch_size)])
+  return np.abs(qvalues - engine.predict(states)).max()
+
+class NumpyNetwork:
+  """
+  Forward pass of exported network using only NumPy. Convolutions are done
+  with im2col and matrix multiplication in channels last order, so that
+  output of one layer is input of the next one without transposing.
+  Workspaces are allocated once for the largest batch seen so far.
+  """
+  def __init__(self, path, batch_size = 1):
+    with np.load(path) as f:
+      data = dict(f.items())
+    self.num_actions = int(data['num_actions'])
+    self.input_shape = tuple(data['input_shape'])
+    self.history_length = self.input_shape[0]
+    self.screen_dim = self.input_shape[1:]
+    self.layers = []
+    while 'W%d' % len(self.layers) in data:
+      i = len(self.layers)
+      conv = tuple(data['conv%d' % i]) or None
+      self.layers.append([data['W%d' % i], data['b%d' % i], bool(data['relu%d' % i]), conv])
+    # screens are used as they are, scaling is folded into first layer
+    self.weights = [W for W, b, relu, conv in self.layers]
+    self.weights[0] = self.weights[0] / np.float32(255)
+    # attributes used by Statistics
+    self.train_iterations = 0
+    self.callback = None
+    self.batch_size = 0
+    self._allocate(batch_size)
+
+  def _allocate(self, batch_size):
+    self.batch_size = batch_size
+    C, H, W = self.input_shape
+    self.input = np.empty((batch_size, H, W, C), dtype = np.float32)
+    # (cols, output, output size) for each layer, cols is None for affine layers
+    self.workspaces = []
+    for weights, b, relu, conv in self.layers:
+      if conv:
+        R, S, stride = conv
+        H = (H - R) // stride + 1
+        W = (W - S) // stride + 1
+        cols = np.empty((batch_size * H * W, weights.shape[0]), dtype = np.float32)
+        output = np.empty((batch_size * H * W, weights.shape[1]), dtype = np.float32)
+      else:
+        cols = None
+        output = np.empty((batch_size, weights.shape[1]), dtype = np.float32)
+      self.workspaces.append((cols, output, (H, W)))
+
+  def predict(self, states):
+    num_states = states.shape[0]
+    assert states.shape[1:] == self.input_shape
+    if num_states > self.batch_size:
+      self._allocate(num_states)
+    x = self.input[:num_states]
+    x[...] = states.transpose((0, 2, 3, 1))
+    for weights, (_, b, relu, conv), (cols, output, (H, W)) in zip(self.weights, self.layers, self.workspaces):
+      if conv:
+        R, S, stride = conv
+        cols, P, Q = im2col(x, R, S, stride, cols[:num_states * H * W])
+        y = output[:num_states * H * W]
+      else:
+        cols = x.reshape((num_states, -1))
+        y = output[:num_states]
+      np.dot(cols, weights, out = y)
+      y += b
+      if relu:
+        np.maximum(y, 0, y)
+      x = y.reshape((num_states, H, W, -1)) if conv else y
+    return x.copy()
+
+if __name__ == '__main__':
+  import argparse
+  import time
+  parser = argparse.ArgumentParser()
+  parser.add_argument("model_file", help="Network exported with --export_model.")
+  parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 32], help="Batch sizes to benchmark.")
+  parser.add_argument("--loops", type=int, default=100, help="Number of predictions per batch size.")
+  args = parser.parse_args()
+
+  start = time.time()
+  engine = NumpyNetwork(args.model_file)
+  print "Loading: %.1f ms" % ((time.time() - start) * 1000)
+
+  for batch_size in args.batch_sizes:
+    states = np.random.randint(256, size = (batch_size,) + engine.input_shape).astype(np.uint8)
+    engine.predict(states)
+    start = time.time()
+    for i in xrange(args.loops):
+      engine.predict(states)
+    print "Batch size %d: %.3f ms per prediction" % (batch_size, (time.time() - start) * 1000 / args.loops)
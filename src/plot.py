@@ -9,33 +9,20 @@ parser = argparse.ArgumentParser()
 parser.add_argument("csv_file")
 parser.add_argument("--png_file")
 parser.add_argument("--dpi", type = int, default = 80)
-parser.add_argument("--skiprows", type = int, default = 1)
+parser.add_argument("--skiprows", type = int, default = 1, help = "Number of rows to skip, the last of them is header with field names.")
 parser.add_argument("--delimiter", default = ",")
 parser.add_argument("--fields", type = lambda s: [item for item in s.split(',')], default = "average_reward,meanq,nr_games,meancost")
 parser.add_argument("--figure_width", type = int, default = 16)
 parser.add_argument("--figure_height", type = int, default = 9)
 args = parser.parse_args()
 
-# field definitions for numpy
-dtype = [
-  ("epoch", "int"), 
-  ("phase", "S6"),
-  ("steps", "int"),
-  ("nr_games", "int"),
-  ("average_reward", "float"),
-  ("min_game_reward", "float"),
-  ("max_game_reward", "float"),
-  ("last_exploration_rate", "float"),
-  ("total_train_steps", "int"),
-  ("replay_memory_count", "int"),
-  ("meanq", "float"),
-  ("meancost", "float"),
-  ("weight_updates", "int"),
-  ("total_time", "float"),
-  ("phase_time", "float"),
-  ("steps_per_second", "float")
-]
-data = np.loadtxt(args.csv_file, skiprows = args.skiprows, delimiter = args.delimiter, dtype = dtype)
+# field names and types are read from the header, so that files with fewer
+# columns written by older versions can be plotted too
+data = np.genfromtxt(args.csv_file, skip_header = args.skiprows - 1, delimiter = args.delimiter, names = True, dtype = None)
+missing = [field for field in args.fields if field not in data.dtype.names]
+if missing:
+  print "Fields not in %s: %s" % (args.csv_file, ", ".join(missing))
+args.fields = [field for field in args.fields if field in data.dtype.names]
 
 # separate phases
 random_idx = data['phase'] == 'random'
@@ -58,8 +45,24 @@ labels = {
   "meancost": "Average loss",
   "weight_updates": "Number of weight updates",
   "total_time": "Total time elapsed",
-  "phase_time": "Phase time",
-  "steps_per_second": "Number of steps per second"
+  "epoch_time": "Phase time",
+  "steps_per_second": "Number of steps per second",
+  "maxq": "Maximum Q-value",
+  "action_entropy": "Entropy of greedy actions",
+  "dominant_action_share": "Share of most common greedy action",
+  "validation_time": "Validation time",
+  "emulation_time": "Emulation time",
+  "preprocessing_time": "Preprocessing time",
+  "prediction_time": "Action prediction time",
+  "state_buffer_time": "State buffer time",
+  "restart_time": "Game restart time",
+  "replay_time": "Replay memory add time",
+  "sampling_time": "Minibatch sampling time",
+  "training_time": "Training time",
+  "priorities_time": "Priority update time",
+  "target_sync_time": "Target network update time",
+  "training_forward_time": "Training forward pass time",
+  "training_backward_time": "Training backward pass time"
 }
 
 # calculate number of subplots
@@ -77,9 +80,9 @@ for i, field in enumerate(args.fields):
   plt.plot(data['epoch'][train_idx], data[field][train_idx])
   plt.plot(data['epoch'][test_idx], data[field][test_idx])
   plt.legend(["Random", "Train", "Test"], loc = "best")
-  plt.ylabel(labels[field])
+  plt.ylabel(labels.get(field, field))
   plt.xlabel(labels['epoch'])
-  plt.title(labels[field])
+  plt.title(labels.get(field, field))
 
 plt.tight_layout()
 
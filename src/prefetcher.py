@@ -0,0 +1,83 @@
+import threading
+import Queue
+import time
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+class MinibatchPrefetcher:
+  """
+  Assembles next minibatches in background thread while network trains on
+  the current one. Minibatches are copied into a ring of preallocated slots,
+  slot is returned to the ring when the next minibatch is requested.
+  Replay memory lock keeps sampling consistent with concurrent add() calls.
+  Has the same sampling interface as replay memory, including indexes and
+  importance sampling weights of prioritized replay.
+  """
+  def __init__(self, mem, args):
+    self.mem = mem
+    self.num_slots = args.prefetch_minibatches
+    self.batch_size = args.batch_size
+    self.slots = [None] * self.num_slots
+    self.free_slots = Queue.Queue()
+    self.full_slots = Queue.Queue()
+    for i in xrange(self.num_slots):
+      self.free_slots.put(i)
+    self.current = None
+    self.indexes = None
+    self.weights = None
+    self.thread = None
+    self.reset()
+
+  def reset(self):
+    # how many minibatches were requested and how often learner had to wait
+    self.num_minibatches = 0
+    self.num_waits = 0
+    self.wait_time = 0
+
+  def start(self):
+    self.thread = threading.Thread(target = self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    if self.thread:
+      self.free_slots.put(None)
+      self.thread.join()
+      self.thread = None
+
+  def _run(self):
+    while True:
+      i = self.free_slots.get()
+      if i is None:
+        break
+      minibatch = self.mem.getMinibatch()
+      # indexes and weights exist only for prioritized replay memory
+      arrays = minibatch + (getattr(self.mem, 'indexes', None), getattr(self.mem, 'weights', None))
+      if self.slots[i] is None:
+        self.slots[i] = tuple(np.empty_like(a) if a is not None else None for a in arrays)
+      for src, dst in zip(arrays, self.slots[i]):
+        if src is not None:
+          np.copyto(dst, src)
+      self.full_slots.put(i)
+
+  def getMinibatch(self):
+    # memory must be populated before sampling starts
+    if self.thread is None:
+      self.start()
+    # return previous minibatch to the ring, it is not used any more
+    if self.current is not None:
+      self.free_slots.put(self.current)
+    try:
+      self.current = self.full_slots.get_nowait()
+    except Queue.Empty:
+      self.num_waits += 1
+      start_time = time.time()
+      self.current = self.full_slots.get()
+      self.wait_time += time.time() - start_time
+    self.num_minibatches += 1
+
+    slot = self.slots[self.current]
+    self.indexes = slot[5]
+    self.weights = slot[6]
+    return slot[:5]
@@ -0,0 +1,115 @@
+import numpy as np
+import cv2
+
+INTERPOLATIONS = {
+  'nearest': cv2.INTER_NEAREST,
+  'linear': cv2.INTER_LINEAR,
+  'area': cv2.INTER_AREA,
+  'cubic': cv2.INTER_CUBIC,
+}
+
+class Preprocessor:
+  """
+  Crops and resizes raw game screens into preallocated buffer, so that no
+  arrays are allocated per step. Returned screen is overwritten by the next
+  call, callers that keep it must copy it.
+  """
+  def __init__(self, args):
+    self.size = (args.screen_width, args.screen_height)
+    # pixels removed from (top, bottom, left, right) before resizing
+    self.crop = args.screen_crop
+    self.interpolation = INTERPOLATIONS[args.screen_interpolation]
+    self.output = np.empty((args.screen_height, args.screen_width), dtype = np.uint8)
+    self.gray = None
+
+  def _crop(self, frame):
+    if self.crop:
+      top, bottom, left, right = self.crop
+      frame = frame[top:frame.shape[0] - bottom, left:frame.shape[1] - right]
+    return frame
+
+  def process(self, frame):
+    # grayscale frame to network input size
+    cv2.resize(self._crop(frame), self.size, dst = self.output, interpolation = self.interpolation)
+    return self.output
+
+  def processRGB(self, frame):
+    if self.gray is None:
+      self.gray = np.empty(frame.shape[:2], dtype = np.uint8)
+    cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst = self.gray)
+    return self.process(self.gray)
+
+if __name__ == '__main__':
+  import argparse
+  import time
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--screen_width", type=int, default=84, help="Screen width after resize.")
+  parser.add_argument("--screen_height", type=int, default=84, help="Screen height after resize.")
+  parser.add_argument("--screen_crop", type=lambda s: tuple(int(x) for x in s.split(',')), help="Pixels to remove from top,bottom,left,right of screen before resize.")
+  parser.add_argument("--screen_interpolation", choices=sorted(INTERPOLATIONS.keys()), default='linear', help="Interpolation used for resizing screen.")
+  parser.add_argument("--raw_height", type=int, default=210, help="Raw screen height.")
+  parser.add_argument("--raw_width", type=int, default=160, help="Raw screen width.")
+  parser.add_argument("--loops", type=int, default=100000, help="Number of steps to measure.")
+  args = parser.parse_args()
+
+  # synthetic game frames with static background and moving object
+  frames = np.zeros((16, args.raw_height, args.raw_width, 1), dtype = np.uint8)
+  frames[:, 50:60] = 142
+  for i in xrange(len(frames)):
+    frames[i, 100 + i:110 + i, 70:75] = 255
+  class FakeALE:
+    # mimics getScreenGrayscale() of ALE Python interface
+    i = 0
+    def getScreenGrayscale(self, screen_data = None):
+      if screen_data is None:
+        screen_data = np.empty((args.raw_height, args.raw_width, 1), dtype = np.uint8)
+      screen_data[...] = frames[self.i % len(frames)]
+      self.i += 1
+      return screen_data
+  ale = FakeALE()
+
+  # previous implementation: new raw screen and new resized screen every step
+  start = time.time()
+  for i in xrange(args.loops):
+    screen = ale.getScreenGrayscale()
+    resized = cv2.resize(screen, (args.screen_width, args.screen_height))
+  elapsed = time.time() - start
+  print "Allocating: %f us per step, %d bytes allocated per step" % (elapsed * 1000000 / args.loops, screen.nbytes + resized.nbytes)
+
+  # preallocated buffers, including max over last two raw frames
+  preprocessor = Preprocessor(args)
+  raw_screens = np.zeros((2, args.raw_height, args.raw_width, 1), dtype = np.uint8)
+  pooled = np.empty_like(raw_screens[0])
+  start = time.time()
+  for i in xrange(args.loops):
+    ale.getScreenGrayscale(raw_screens[i % 2])
+    np.maximum(raw_screens[0], raw_screens[1], out = pooled)
+    screen = preprocessor.process(pooled[..., 0])
+  elapsed = time.time() - start
+  print "Preallocated with max pooling: %f us per step" % (elapsed * 1000000 / args.loops)
+
+  # check that every OpenCV call gets preallocated dst and writes into it,
+  # temporaries inside OpenCV itself can't be counted from Python 2
+  def address(array):
+    return array.__array_interface__['data'][0]
+  calls, misses = [0], [0]
+  def checked(function):
+    def call(src, *rest, **kwargs):
+      dst = kwargs.get('dst')
+      result = function(src, *rest, **kwargs)
+      calls[0] += 1
+      if dst is None or address(result) != address(dst):
+        misses[0] += 1
+      return result
+    return call
+  resize, cvtColor = cv2.resize, cv2.cvtColor
+  cv2.resize, cv2.cvtColor = checked(resize), checked(cvtColor)
+  rgb = np.empty((args.raw_height, args.raw_width, 3), dtype = np.uint8)
+  for i in xrange(1000):
+    ale.getScreenGrayscale(raw_screens[i % 2])
+    np.maximum(raw_screens[0], raw_screens[1], out = pooled)
+    preprocessor.process(pooled[..., 0])
+    rgb[...] = pooled
+    preprocessor.processRGB(rgb)
+  cv2.resize, cv2.cvtColor = resize, cvtColor
+  print "Preallocated: %d of %d OpenCV calls didn't write to preallocated dst" % (misses[0], calls[0])
@@ -0,0 +1,217 @@
+import copy
+import numpy as np
+from numpy_network import im2col, network_layers
+from replay_memory import ReplayMemory
+import logging
+logger = logging.getLogger(__name__)
+
+# float32 sums of integer products are exact below 2**24, so products of
+# int8 weights and uint8 activations are summed in pieces of at most this many
+MAX_EXACT_TERMS = (2 ** 24 - 1) // (127 * 255)
+
+class QuantizedLayer:
+  def __init__(self, W, b, relu, conv = None):
+    # conv is (R, S, stride) for convolutional layers, None for affine layers
+    self.conv = conv
+    self.relu = relu
+    self.b = b
+    # symmetric per output channel quantization of weights
+    self.w_scale = np.abs(W).max(axis = 0) / 127.
+    self.w_scale[self.w_scale == 0] = 1
+    # int8 values are kept in float32, so that BLAS can multiply them
+    self.Wq = np.ascontiguousarray(np.rint(W / self.w_scale), dtype = np.float32)
+    # row ranges of Wq whose sums are exact
+    self.pieces = [(i, min(i + MAX_EXACT_TERMS, len(W))) for i in xrange(0, len(W), MAX_EXACT_TERMS)]
+    # float weights are needed only for calibration
+    self.W = W
+    # scale of quantized input, set by calibration
+    self.x_scale = None
+    # converts integer products to float output
+    self.scale = None
+
+  def forward(self, x):
+    # forward pass in float precision, used for calibration
+    if self.conv:
+      R, S, stride = self.conv
+      cols, P, Q = im2col(x, R, S, stride)
+      shape = (x.shape[0], P, Q, -1)
+    else:
+      cols, shape = x.reshape((x.shape[0], -1)), (x.shape[0], -1)
+    y = np.dot(cols, self.W) + self.b
+    if self.relu:
+      np.maximum(y, 0, y)
+    return y.reshape(shape)
+
+class QuantizedNetwork:
+  """
+  Post-training 8-bit quantization of DeepQNetwork for CPU inference.
+  Weights are quantized per output channel to int8 values, activations after
+  rectifiers are quantized to uint8 values using scales calibrated on given
+  states. Input screens are already 8-bit and are used as they are. NumPy
+  has no integer BLAS, so the integer values are multiplied with float32
+  BLAS, summing at most MAX_EXACT_TERMS products at a time, which keeps
+  the sums exact. Buffers are allocated once for the largest batch seen so far.
+  Works with both DeepQNetwork and NumpyNetwork.
+  """
+  def __init__(self, net, states):
+    self.num_actions = net.num_actions
+    self.input_shape = (net.history_length,) + net.screen_dim
+    self.layers = [QuantizedLayer(W, b, relu, conv) for W, b, relu, conv in network_layers(net)]
+    self._calibrate(states)
+    for layer in self.layers:
+      layer.W = None
+    self.batch_size = 0
+    self._allocate(1)
+
+  def _input(self, states):
+    # screens are in channels last order for im2col
+    return np.ascontiguousarray(states.transpose((0, 2, 3, 1)), dtype = np.float32)
+
+  def _calibrate(self, states):
+    # input screens have values 0..255, network input is divided by 255
+    self.layers[0].x_scale = 1 / 255.
+    x = self._input(states) * self.layers[0].x_scale
+    for layer, next_layer in zip(self.layers[:-1], self.layers[1:]):
+      x = layer.forward(x)
+      assert layer.relu, "Only rectified activations can be quantized"
+      next_layer.x_scale = max(x.max(), 1e-8) / 255.
+      # calibrate next layer with quantized input, so that errors are included
+      x = np.rint(x / next_layer.x_scale) * next_layer.x_scale
+    for layer in self.layers:
+      layer.scale = (layer.x_scale * layer.w_scale).astype(np.float32)
+    logger.info("Quantization scales: %s" % ", ".join("%g" % layer.x_scale for layer in self.layers))
+
+  def _allocate(self, batch_size):
+    self.batch_size = batch_size
+    C, H, W = self.input_shape
+    self.input = np.empty((batch_size, H, W, C), dtype = np.float32)
+    # (cols, products, sums, output, output size) for each layer, cols is
+    # None for affine layers and sums is None when products are summed at once
+    self.workspaces = []
+    for layer in self.layers:
+      if layer.conv:
+        R, S, stride = layer.conv
+        H = (H - R) // stride + 1
+        W = (W - S) // stride + 1
+        rows = batch_size * H * W
+        cols = np.empty((rows, layer.Wq.shape[0]), dtype = np.float32)
+      else:
+        rows = batch_size
+        cols = None
+      outputs = layer.Wq.shape[1]
+      sums = np.empty((rows, outputs), dtype = np.float64) if len(layer.pieces) > 1 else None
+      self.workspaces.append((cols, np.empty((rows, outputs), dtype = np.float32), sums,
+          np.empty((rows, outputs), dtype = np.float32), (H, W)))
+
+  def predict(self, states):
+    num_states = states.shape[0]
+    assert states.shape[1:] == self.input_shape
+    if num_states > self.batch_size:
+      self._allocate(num_states)
+    x = self.input[:num_states]
+    x[...] = states.transpose((0, 2, 3, 1))
+    for i, (layer, (cols, products, sums, output, (H, W))) in enumerate(zip(self.layers, self.workspaces)):
+      if layer.conv:
+        R, S, stride = layer.conv
+        rows = num_states * H * W
+        cols, P, Q = im2col(x, R, S, stride, cols[:rows])
+      else:
+        rows = num_states
+        cols = x.reshape((num_states, -1))
+      # uint8 activations times int8 weights, exact integer sums
+      products = products[:rows]
+      if sums is None:
+        np.dot(cols, layer.Wq, out = products)
+      else:
+        sums = sums[:rows]
+        for j, (begin, end) in enumerate(layer.pieces):
+          np.dot(cols[:, begin:end], layer.Wq[begin:end], out = products)
+          if j == 0:
+            sums[...] = products
+          else:
+            sums += products
+        products = sums
+      y = output[:rows]
+      np.multiply(products, layer.scale, out = y)
+      y += layer.b
+      if layer.relu:
+        np.maximum(y, 0, y)
+      if i == len(self.layers) - 1:
+        return y.copy()
+      # quantize activations for next layer, values above calibrated range saturate
+      y /= self.layers[i + 1].x_scale
+      np.rint(y, y)
+      np.minimum(y, 255, y)
+      x = y.reshape((num_states, H, W, -1)) if layer.conv else y
+
+  def agreement(self, net, states):
+    # how often quantized network chooses the same greedy action as float network
+    qvalues = np.vstack([net.predict(states[i:i + net.batch_size]) for i in xrange(0, len(states), net.batch_size)])
+    quantized = self.predict(states)
+    agreement = np.mean(qvalues.argmax(axis = 1) == quantized.argmax(axis = 1))
+    error = np.abs(qvalues - quantized).max()
+    return agreement, error
+
+def calibration_states(agent, args):
+  # states from replay memory, or from random steps played into separate memory
+  if agent.mem.valid_count >= args.quantize_states:
+    return agent.mem.sampleStates(args.quantize_states)
+  logger.info("Collecting %d random states for quantization" % args.quantize_states)
+  calibration_args = copy.copy(args)
+  calibration_args.replay_storage = 'memory'
+  mem, callback = agent.mem, agent.callback
+  agent.mem = ReplayMemory(2 * args.quantize_states, calibration_args)
+  # calibration steps are not part of any phase, so statistics don't see them
+  agent.callback = None
+  agent.env.setMode('test')
+  try:
+    agent.play_random(2 * args.quantize_states)
+    return agent.mem.sampleStates(args.quantize_states)
+  finally:
+    agent.mem, agent.callback = mem, callback
+
+if __name__ == '__main__':
+  import argparse
+  import time
+  from numpy_network import NumpyNetwork
+  from environment import SyntheticEnvironment
+  from agent import Agent
+  from statistics import Statistics
+  parser = argparse.ArgumentParser()
+  parser.add_argument("model_file", help="Network exported with --export_model.")
+  parser.add_argument("--quantize_states", type=int, default=1000, help="Number of states for calibration and agreement.")
+  parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 32], help="Batch sizes to benchmark.")
+  parser.add_argument("--loops", type=int, default=100, help="Number of predictions per batch size.")
+  args = parser.parse_args()
+
+  net = NumpyNetwork(args.model_file)
+  # empty replay memory and statistics attached, like testing with --random_steps 0
+  vars(args).update(
+    history_length = net.history_length, screen_height = net.screen_dim[0], screen_width = net.screen_dim[1],
+    screen_crop = None, screen_interpolation = 'linear', batch_size = 32, num_envs = 1,
+    synthetic_actions = net.num_actions, synthetic_episode_length = 1000, synthetic_reward_prob = 0.01,
+    synthetic_step_cost = 0, synthetic_screen_width = 160, synthetic_screen_height = 210, random_seed = 1,
+    replay_storage = 'memory', replay_file = None, n_step = 1, random_starts = 30, device_history = False,
+    exploration_rate_start = 1, exploration_rate_end = 0.1, exploration_decay_steps = 1000000, exploration_rate_test = 0.05,
+    start_epoch = 0, train_steps = 0, train_frequency = 4, train_repeat = 1, target_steps = 0, prioritized_replay = False,
+    prefetch_minibatches = False, learner_thread = False, csv_file = None, validation_states = None)
+  env = SyntheticEnvironment(args)
+  mem = ReplayMemory(1000, args)
+  agent = Agent(env, mem, net, args)
+  stats = Statistics(agent, net, mem, env, args)
+  states = calibration_states(agent, args)
+  assert agent.callback is stats and agent.mem is mem and mem.count == 0
+
+  # calibrate on half of the states, measure agreement on the other half
+  quantized_net = QuantizedNetwork(net, states[::2])
+  agreement, error = quantized_net.agreement(net, states[1::2])
+  print "Agreement: %.1f%%, maximum Q-value error %f" % (agreement * 100, error)
+
+  for batch_size in args.batch_sizes:
+    batch = states[:batch_size]
+    for name, engine in (("float", net), ("quantized", quantized_net)):
+      engine.predict(batch)
+      start = time.time()
+      for i in xrange(args.loops):
+        engine.predict(batch)
+      print "Batch size %d, %s: %.3f ms per prediction" % (batch_size, name, (time.time() - start) * 1000 / args.loops)
@@ -1,39 +1,151 @@
 import numpy as np
 import random
+import tempfile
+import threading
 import logging
 logger = logging.getLogger(__name__)
+from sum_tree import SumTree
+from frame_store import CompressedFrameStore
 
-class ReplayMemory:
+class ReplayMemory(object):
   def __init__(self, size, args):
     self.size = size
     # preallocate memory
-    self.actions = np.empty(self.size, dtype = np.uint8)
-    self.rewards = np.empty(self.size, dtype = np.integer)
-    self.screens = np.empty((self.size, args.screen_height, args.screen_width), dtype = np.uint8)
-    self.terminals = np.empty(self.size, dtype = np.bool)
+    self.actions = self._allocate(self.size, np.uint8)
+    self.rewards = self._allocate(self.size, np.integer)
+    self.screens = self._allocateScreens((self.size, args.screen_height, args.screen_width), args)
+    self.terminals = self._allocate(self.size, np.bool)
     self.history_length = args.history_length
     self.dims = (args.screen_height, args.screen_width)
     self.batch_size = args.batch_size
     self.count = 0
     self.current = 0
+    # total number of added screens, tells which screens have changed
+    self.num_added = 0
+    # guards memory when it is filled and sampled from different threads
+    self.lock = threading.Lock()
 
-    # pre-allocate prestates and poststates for minibatch
-    self.prestates = np.empty((self.batch_size, self.history_length) + self.dims, dtype = np.uint8)
-    self.poststates = np.empty((self.batch_size, self.history_length) + self.dims, dtype = np.uint8)
+    # set of indexes that can be sampled, kept up to date in add(),
+    # valid_positions maps index to its position in valid_indexes or -1
+    self.valid_indexes = self._allocate(self.size, np.int64)
+    self.valid_positions = self._allocate(self.size, np.int64)
+    self.valid_positions.fill(-1)
+    self.valid_count = 0
+
+    # n-step returns are accumulated incrementally in add(), transition
+    # becomes valid when it has n rewards or its episode has ended
+    self.n_step = args.n_step
+    if self.n_step > 1:
+      self.returns = self._allocate(self.size, np.float32)
+      self.return_terminals = self._allocate(self.size, np.bool)
+      self.discounts = [args.discount_rate ** k for k in xrange(self.n_step)]
+      self.min_reward = args.min_reward
+      self.max_reward = args.max_reward
+      # transitions waiting for more rewards, oldest first
+      self.pending = []
+
+    # pre-allocate prestates and poststates for minibatch,
+    # with 1-step returns both are views to the same gathered history
+    if self.n_step > 1:
+      self.states = np.empty((self.batch_size, 2 * self.history_length) + self.dims, dtype = np.uint8)
+    else:
+      self.states = np.empty((self.batch_size, self.history_length + 1) + self.dims, dtype = np.uint8)
+    self.prestates = self.states[:, :self.history_length]
+    self.poststates = self.states[:, -self.history_length:]
+    # offsets of prestate and poststate screens relative to sampled index
+    self.offsets = np.arange(-self.history_length, 1)
 
     logger.info("Replay memory size: %d" % self.size)
 
+  def _allocate(self, shape, dtype):
+    return np.empty(shape, dtype = dtype)
+
+  def _allocateScreens(self, shape, args):
+    if args.replay_storage == 'memmap':
+      # screens live in a file, OS page cache keeps recently written and
+      # sampled pages in RAM and evicts the rest when memory is needed
+      if args.replay_file:
+        logger.info("Storing replay memory screens in %s" % args.replay_file)
+        filename = args.replay_file
+      else:
+        # anonymous temporary file is removed when memory is closed
+        filename = tempfile.TemporaryFile()
+      return np.memmap(filename, dtype = np.uint8, mode = 'w+', shape = shape)
+    elif args.replay_storage == 'compressed':
+      # screens are compressed in chunks and decompressed when sampled
+      logger.info("Compressing replay memory screens in chunks of %d" % args.replay_chunk_size)
+      return CompressedFrameStore(shape, args.replay_chunk_size, args.replay_cache_chunks)
+    else:
+      assert args.replay_storage == 'memory', "Unknown replay storage " + args.replay_storage
+      return self._allocate(shape, np.uint8)
+
   def add(self, action, reward, screen, terminal):
     assert screen.shape == self.dims
-    # NB! screen is post-state, after action and reward
-    self.actions[self.current] = action
-    self.rewards[self.current] = reward
-    self.screens[self.current, ...] = screen
-    self.terminals[self.current] = terminal
-    self.count = max(self.count, self.current + 1)
-    self.current = (self.current + 1) % self.size
+    with self.lock:
+      # NB! screen is post-state, after action and reward
+      self.actions[self.current] = action
+      self.rewards[self.current] = reward
+      self.screens[self.current, ...] = screen
+      self.terminals[self.current] = terminal
+      self._updateValid(self.current)
+      self.count = max(self.count, self.current + 1)
+      self.current = (self.current + 1) % self.size
+      self.num_added += 1
     #logger.debug("Memory count %d" % self.count)
-  
+
+  def _updateValid(self, index):
+    # history of index + history_length now includes the overwritten screen
+    self._removeValid((index + self.history_length) % self.size)
+    if self.n_step > 1:
+      self._updateReturns(index)
+    elif self._isValidPrestate(index):
+      self._addValid(index)
+
+  def _isValidPrestate(self, index):
+    # index can be used if its history doesn't wrap over the beginning
+    # of the matrix or over episode end, poststate can be terminal
+    return index >= self.history_length and not self.terminals[(index - self.history_length):index].any()
+
+  def _updateReturns(self, index):
+    reward = min(max(self.rewards[index], self.min_reward), self.max_reward)
+    terminal = self.terminals[index]
+    self.returns[index] = 0
+    self.pending.append(index)
+    # add discounted reward to returns of all pending transitions
+    for k, pending_index in enumerate(reversed(self.pending)):
+      self.returns[pending_index] += self.discounts[k] * reward
+    if terminal:
+      # episode ended, returns of all pending transitions are final
+      completed = self.pending
+      self.pending = []
+    elif len(self.pending) == self.n_step:
+      # oldest pending transition has collected n rewards
+      completed = [self.pending.pop(0)]
+    else:
+      completed = []
+    for completed_index in completed:
+      self.return_terminals[completed_index] = terminal
+      if self._isValidPrestate(completed_index):
+        self._addValid(completed_index)
+
+  def _addValid(self, index):
+    if self.valid_positions[index] >= 0:
+      return
+    self.valid_indexes[self.valid_count] = index
+    self.valid_positions[index] = self.valid_count
+    self.valid_count += 1
+
+  def _removeValid(self, index):
+    position = self.valid_positions[index]
+    if position < 0:
+      return
+    # move last valid index in place of removed one
+    self.valid_count -= 1
+    last = self.valid_indexes[self.valid_count]
+    self.valid_indexes[position] = last
+    self.valid_positions[last] = position
+    self.valid_positions[index] = -1
+
   def getState(self, index):
     assert self.count > 0, "replay memory is empy, use at least --random_steps 1"
     # normalize index to expected range, allows negative indexes
@@ -47,33 +159,197 @@ class ReplayMemory:
       indexes = [(index - i) % self.count for i in reversed(range(self.history_length))]
       return self.screens[indexes, ...]
 
+  def _sampleIndexes(self, batch_size):
+    # sample uniformly among valid indexes, no rejection needed
+    positions = np.random.randint(self.valid_count, size = batch_size)
+    return self.valid_indexes[positions]
+
+  def _getTransitions(self, indexes, states):
+    # gather prestate and poststate screens of all samples at once,
+    # valid indexes never wrap, but mode 'wrap' avoids buffering of out
+    # NB! having index first is fastest in C-order matrices
+    if self.n_step > 1:
+      # n-step poststate is n - 1 screens later, unless episode ended
+      terminals = self.return_terminals[indexes]
+      bootstraps = indexes + (self.n_step - 1) * ~terminals
+      screen_indexes = np.hstack((indexes[:, np.newaxis] + self.offsets[:-1], bootstraps[:, np.newaxis] + self.offsets[1:]))
+      rewards = self.returns[indexes]
+    else:
+      screen_indexes = indexes[:, np.newaxis] + self.offsets
+      terminals = self.terminals[indexes]
+      rewards = self.rewards[indexes]
+    self.screens.take(screen_indexes, axis = 0, out = states, mode = 'wrap')
+    actions = self.actions[indexes]
+    return actions, rewards, terminals
+
   def getMinibatch(self):
     # memory must include poststate, prestate and history
     assert self.count > self.history_length
-    # sample random indexes
-    indexes = []
-    while len(indexes) < self.batch_size:
-      # find random index 
-      while True:
-        # sample one index (ignore states wraping over 
-        index = random.randint(self.history_length, self.count - 1)
-        # if wraps over current pointer, then get new one
-        if index >= self.current and index - self.history_length < self.current:
-          continue
-        # if wraps over episode end, then get new one
-        # NB! poststate (last screen) can be terminal state!
-        if self.terminals[(index - self.history_length):index].any():
-          continue
-        # otherwise use this index
-        break
-      
-      # NB! having index first is fastest in C-order matrices
-      self.prestates[len(indexes), ...] = self.getState(index - 1)
-      self.poststates[len(indexes), ...] = self.getState(index)
-      indexes.append(index)
-
-    # copy actions, rewards and terminals with direct slicing
-    actions = self.actions[indexes]
-    rewards = self.rewards[indexes]
-    terminals = self.terminals[indexes]
+    assert self.valid_count > 0, "no valid states in replay memory, episodes are shorter than history"
+    with self.lock:
+      indexes = self._sampleIndexes(self.batch_size)
+      actions, rewards, terminals = self._getTransitions(indexes, self.states)
     return self.prestates, actions, rewards, self.poststates, terminals
+
+  def sampleStates(self, num_states):
+    # distinct random prestates, doesn't use minibatch buffers or priorities
+    with self.lock:
+      assert self.valid_count > 0, "no valid states in replay memory, use at least --random_steps 1"
+      num_states = min(num_states, self.valid_count)
+      indexes = np.random.choice(self.valid_indexes[:self.valid_count], size = num_states, replace = False)
+      return self.screens.take(indexes[:, np.newaxis] + self.offsets[:-1], axis = 0, mode = 'wrap')
+
+class PartitionedReplayMemory(object):
+  """
+  Samples minibatches from several replay memories, each filled by its own
+  environment, so that histories of different environments don't mix.
+  Number of samples from each partition is proportional to the number of
+  valid transitions in it.
+  """
+  def __init__(self, partitions, args):
+    self.partitions = partitions
+    self.size = sum(partition.size for partition in partitions)
+    self.history_length = args.history_length
+    self.dims = (args.screen_height, args.screen_width)
+    self.batch_size = args.batch_size
+
+    # pre-allocate prestates and poststates for minibatch like partitions do
+    self.states = np.empty((self.batch_size,) + partitions[0].states.shape[1:], dtype = np.uint8)
+    self.prestates = self.states[:, :self.history_length]
+    self.poststates = self.states[:, -self.history_length:]
+
+  @property
+  def count(self):
+    return sum(partition.count for partition in self.partitions)
+
+  def getMinibatch(self):
+    valid_counts = np.array([partition.valid_count for partition in self.partitions], dtype = np.float64)
+    assert valid_counts.sum() > 0, "no valid states in replay memory partitions"
+    samples = np.random.multinomial(self.batch_size, valid_counts / valid_counts.sum())
+    start = 0
+    actions, rewards, terminals = [], [], []
+    for partition, num_samples in zip(self.partitions, samples):
+      if num_samples == 0:
+        continue
+      # partition can be filled concurrently, lock it for sampling
+      with partition.lock:
+        indexes = partition._sampleIndexes(num_samples)
+        transitions = partition._getTransitions(indexes, self.states[start:start + num_samples])
+      actions.append(transitions[0])
+      rewards.append(transitions[1])
+      terminals.append(transitions[2])
+      start += num_samples
+    return self.prestates, np.concatenate(actions), np.concatenate(rewards), self.poststates, np.concatenate(terminals)
+
+  @property
+  def valid_count(self):
+    return sum(partition.valid_count for partition in self.partitions)
+
+  def sampleStates(self, num_states):
+    valid_counts = np.array([partition.valid_count for partition in self.partitions], dtype = np.float64)
+    assert valid_counts.sum() > 0, "no valid states in replay memory partitions, use at least --random_steps 1"
+    samples = np.random.multinomial(min(num_states, int(valid_counts.sum())), valid_counts / valid_counts.sum())
+    # partitions without samples may have no valid states yet
+    return np.concatenate([partition.sampleStates(num_samples) for partition, num_samples in zip(self.partitions, samples) if num_samples])
+
+class PrioritizedReplayMemory(ReplayMemory):
+  """
+  Samples transitions with probability proportional to their priority,
+  which is derived from the last TD error. Priorities are kept in sum tree,
+  invalid indexes have zero priority, so they are never sampled.
+  """
+  def __init__(self, size, args):
+    self.tree = SumTree(size)
+    self.alpha = args.priority_alpha
+    self.beta = args.priority_beta
+    self.epsilon = args.priority_epsilon
+    # new transitions get the highest priority seen so far
+    self.max_priority = 1.0
+    ReplayMemory.__init__(self, size, args)
+
+    # indexes and importance sampling weights of the last minibatch
+    self.indexes = np.zeros(self.batch_size, dtype = np.int64)
+    self.weights = np.ones(self.batch_size, dtype = np.float32)
+
+  def _addValid(self, index):
+    ReplayMemory._addValid(self, index)
+    self.tree.set(index, self.max_priority)
+
+  def _removeValid(self, index):
+    if self.valid_positions[index] >= 0:
+      ReplayMemory._removeValid(self, index)
+      self.tree.set(index, 0)
+
+  def _sampleIndexes(self, batch_size):
+    # stratified sampling, one sample from each equal priority segment
+    total = self.tree.total()
+    assert total > 0, "no valid states with priority in replay memory"
+    values = (np.arange(batch_size) + np.random.random(batch_size)) * (total / batch_size)
+    # last segment boundary can round up to total
+    np.minimum(values, total * (1 - 1e-12), values)
+    indexes = self.tree.find(values)
+    # importance sampling weights, normalized so that max weight is 1
+    probabilities = self.tree.get(indexes) / total
+    weights = (self.valid_count * probabilities) ** -self.beta
+    self.indexes[:] = indexes
+    self.weights[:] = weights / weights.max()
+    return indexes
+
+  def updatePriorities(self, indexes, errors):
+    priorities = (np.abs(errors) + self.epsilon) ** self.alpha
+    with self.lock:
+      # skip transitions that were overwritten after sampling
+      valid = self.valid_positions[indexes] >= 0
+      self.tree.update(indexes[valid], priorities[valid])
+      self.max_priority = max(self.max_priority, priorities.max())
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--screen_width", type=int, default=84, help="Screen width after resize.")
+  parser.add_argument("--screen_height", type=int, default=84, help="Screen height after resize.")
+  parser.add_argument("--replay_size", type=int, default=100000, help="Maximum size of replay memory.")
+  parser.add_argument("--history_length", type=int, default=4, help="How many screen frames form a state.")
+  parser.add_argument("--replay_storage", choices=["memory", "memmap", "compressed"], default="memory", help="Keep replay memory screens in RAM, in memory-mapped file or compressed in RAM.")
+  parser.add_argument("--replay_file", help="File for memory-mapped replay memory screens, temporary file by default.")
+  parser.add_argument("--replay_chunk_size", type=int, default=4, help="How many consecutive screens are compressed together.")
+  parser.add_argument("--replay_cache_chunks", type=int, default=256, help="How many decompressed chunks to cache.")
+  parser.add_argument("--prioritized_replay", action="store_true", help="Use prioritized replay memory.")
+  parser.add_argument("--priority_alpha", type=float, default=0.6, help="How much prioritization is used, 0 is uniform.")
+  parser.add_argument("--priority_beta", type=float, default=0.4, help="How much importance sampling weights compensate for prioritization.")
+  parser.add_argument("--priority_epsilon", type=float, default=1e-6, help="Small constant added to priorities.")
+  parser.add_argument("--n_step", type=int, default=1, help="Number of rewards in returns.")
+  parser.add_argument("--discount_rate", type=float, default=0.99, help="Discount rate for future rewards.")
+  parser.add_argument("--min_reward", type=float, default=-1, help="Minimum reward.")
+  parser.add_argument("--max_reward", type=float, default=1, help="Maximum reward.")
+  parser.add_argument("--batch_size", type=int, default=32, help="Batch size for neural network.")
+  parser.add_argument("--terminal_prob", type=float, default=0.01, help="Probability of terminal state.")
+  parser.add_argument("--loops", type=int, default=10000, help="Number of loops in testing.")
+  args = parser.parse_args()
+
+  import time
+  if args.prioritized_replay:
+    mem = PrioritizedReplayMemory(args.replay_size, args)
+  else:
+    mem = ReplayMemory(args.replay_size, args)
+  # static background with a few moving objects, roughly like Atari games
+  background = np.repeat(np.random.randint(0, 256, size=(args.screen_height, 1)), args.screen_width, axis=1).astype(np.uint8)
+  screens = np.empty((1000, args.screen_height, args.screen_width), dtype=np.uint8)
+  for i in xrange(len(screens)):
+    screens[i] = background
+    for j in xrange(3):
+      y = (i * (j + 1)) % (args.screen_height - 4)
+      x = (i * (3 - j)) % (args.screen_width - 4)
+      screens[i, y:y + 4, x:x + 4] = 255
+  start = time.time()
+  for i in xrange(args.replay_size):
+    mem.add(0, 0, screens[i % len(screens)], random.random() < args.terminal_prob)
+  print "add: %f us" % ((time.time() - start) / args.replay_size * 1e6)
+  start = time.time()
+  for i in xrange(args.loops):
+    minibatch = mem.getMinibatch()
+    if args.prioritized_replay:
+      mem.updatePriorities(mem.indexes, np.random.random(args.batch_size))
+  print "getMinibatch: %f us" % ((time.time() - start) / args.loops * 1e6)
+  if args.replay_storage == 'compressed':
+    print "compression ratio: %f" % mem.screens.compressionRatio()
@@ -5,29 +5,116 @@ class StateBuffer:
   While ReplayMemory could have been used for fetching the current state,
   this also means that test time states make their way to training process.
   Having separate StateBuffer ensures that test data doesn't leak into training.
+
+  Each row holds a longer run of screens than one state, new screen is written
+  once to the next free slot and state is a view of the last history_length
+  slots. When row is full, only the last history_length - 1 screens are moved
+  to its beginning, so history is not shifted on every step.
+
+  Screens of training steps are already written to replay memory, addShared()
+  refers to them there instead of copying them again. When whole history is
+  in consecutive replay memory slots, state is a view of replay memory.
+  Only screens added to replay memory are shared, so test screens still
+  don't get there.
   """
   def __init__(self, args):
     self.history_length = args.history_length
     self.dims = (args.screen_height, args.screen_width)
     self.batch_size = args.batch_size
-    self.buffer = np.zeros((self.batch_size, self.history_length) + self.dims, dtype=np.uint8)
+    # history is moved once per row_length - history_length + 1 screens
+    self.row_length = 4 * self.history_length
+    self.buffer = np.zeros((self.batch_size, self.row_length) + self.dims, dtype=np.uint8)
+    # next free slot of each row, history is the slots before it
+    self.positions = np.empty(self.batch_size, dtype=np.int64)
+    # flat indexes of history slots relative to the next free slot
+    self.offsets = np.arange(-self.history_length, 0)
+    self.row_offsets = np.arange(self.batch_size)[:, np.newaxis] * self.row_length
+    self.minibatch = np.empty((self.batch_size, self.history_length) + self.dims, dtype=np.uint8)
+    # replay memory of each row, number of the latest screens of history that
+    # are in it and the slot after the last of them
+    self.memories = [None] * self.batch_size
+    self.shared = np.empty(self.batch_size, dtype=np.int64)
+    self.shared_ends = np.empty(self.batch_size, dtype=np.int64)
+    self.reset()
 
-  def add(self, observation):
+  def add(self, observation, index = 0):
+    # each row of minibatch can hold history of separate environment
     assert observation.shape == self.dims
-    self.buffer[0, :-1] = self.buffer[0, 1:]
-    self.buffer[0, -1] = observation
+    if self.shared[index]:
+      self._unshare(index)
+    self._write(observation, index)
+
+  def addShared(self, mem, index = 0):
+    # screen that was just added to replay memory becomes the latest screen
+    assert mem.size > self.history_length
+    slot = (mem.current - 1) % mem.size
+    if self.shared[index] and (mem is not self.memories[index] or slot != self.shared_ends[index] % mem.size):
+      self._unshare(index)
+    self.memories[index] = mem
+    self.shared[index] = min(self.shared[index] + 1, self.history_length)
+    self.shared_ends[index] = slot + 1
+
+  def _write(self, observation, index):
+    position = self.positions[index]
+    if position == self.row_length:
+      # row is full, keep the screens needed for the next states
+      position = self.history_length - 1
+      self.buffer[index, :position] = self.buffer[index, self.row_length - position:]
+    self.buffer[index, position] = observation
+    self.positions[index] = position + 1
+
+  def _unshare(self, index):
+    # copy shared screens to the row, so that history continues there
+    mem = self.memories[index]
+    end = self.shared_ends[index]
+    for slot in xrange(end - self.shared[index], end):
+      self._write(mem.screens[slot % mem.size], index)
+    self.shared[index] = 0
+
+  def _gather(self, index, state):
+    # copy history made of own and shared screens to state
+    shared = self.shared[index]
+    own = self.history_length - shared
+    position = self.positions[index]
+    state[:own] = self.buffer[index, position - own:position]
+    if shared:
+      end = self.shared_ends[index]
+      self.memories[index].screens.take(np.arange(end - shared, end), axis = 0, out = state[own:], mode = 'wrap')
+    return state
 
-  def getState(self):
-    return self.buffer[0]
+  def getState(self, index = 0):
+    # view of the buffer or replay memory, valid until the next add() to the same row
+    shared = self.shared[index]
+    if shared == 0:
+      position = self.positions[index]
+      return self.buffer[index, position - self.history_length:position]
+    end = self.shared_ends[index]
+    if shared == self.history_length and end >= shared:
+      return self.memories[index].screens[end - shared:end]
+    return self._gather(index, self.minibatch[index])
 
-  def getStateMinibatch(self):
-    return self.buffer
+  def getStateMinibatch(self, count = None):
+    # states of the first count rows gathered to contiguous minibatch
+    if count is None:
+      count = self.batch_size
+    if self.shared[:count].any():
+      for index in xrange(count):
+        self._gather(index, self.minibatch[index])
+      return self.minibatch[:count]
+    indexes = self.row_offsets[:count] + self.positions[:count, np.newaxis] + self.offsets
+    flat = self.buffer.reshape((-1,) + self.dims)
+    return flat.take(indexes, axis = 0, out = self.minibatch[:count])
 
   def reset(self):
     self.buffer *= 0
+    self.positions.fill(self.history_length)
+    self.memories = [None] * self.batch_size
+    self.shared.fill(0)
+    self.shared_ends.fill(0)
 
 if __name__ == '__main__':
   import argparse
+  import time
   parser = argparse.ArgumentParser()
   parser.add_argument("--screen_width", type=int, default=40, help="Screen width after resize.")
   parser.add_argument("--screen_height", type=int, default=52, help="Screen height after resize.")
@@ -36,10 +123,19 @@ if __name__ == '__main__':
   parser.add_argument("--loops", type=int, default=1000000, help="Number of loops in testing.")
   args = parser.parse_args()
 
-  import numpy as np
   mem = StateBuffer(args)
+  screens = np.random.randint(256, size = (args.history_length + 1, args.screen_height, args.screen_width)).astype(np.uint8)
+  start = time.time()
   for i in xrange(args.loops):
-    mem.add(np.zeros((args.screen_height, args.screen_width)))
+    mem.add(screens[i % len(screens)])
     if i >= args.history_length:
       state = mem.getState()
-      batch = mem.getStateMinibatch()
\ No newline at end of file
+  print "add + getState: %f us" % ((time.time() - start) / args.loops * 1e6)
+  # states must be the same as with shifted history
+  for i in xrange(args.history_length):
+    assert np.array_equal(state[-1 - i], screens[(args.loops - 1 - i) % len(screens)])
+  start = time.time()
+  for i in xrange(args.loops // 100):
+    batch = mem.getStateMinibatch()
+  print "getStateMinibatch: %f us" % ((time.time() - start) / (args.loops // 100) * 1e6)
+  assert np.array_equal(batch[0], state)
@@ -4,6 +4,7 @@ import time
 import logging
 import numpy as np
 logger = logging.getLogger(__name__)
+from frame_store import CompressedFrameStore
 
 class Statistics:
   def __init__(self, agent, net, mem, env, args):
@@ -11,6 +12,14 @@ class Statistics:
     self.net = net
     self.mem = mem
     self.env = env
+    self.num_envs = args.num_envs
+    # time breakdown columns, NumpyNetwork used only for acting doesn't train
+    self.timers = [self.agent.timers]
+    if hasattr(self.net, 'timers'):
+      self.timers.append(self.net.timers)
+    self.timer_names = self.agent.timers.names
+    # forward and backward pass are parts of training time, not added to it
+    self.training_timer_names = ['forward', 'backward']
 
     self.agent.callback = self
     self.net.callback = self
@@ -36,64 +45,79 @@ class Statistics:
           "weight_updates",
           "total_time",
           "epoch_time",
-          "steps_per_second"
-        ))
+          "steps_per_second",
+          "maxq",
+          "action_entropy",
+          "dominant_action_share",
+          "validation_time"
+        ) + tuple(name + "_time" for name in self.timer_names)
+          + tuple("training_" + name + "_time" for name in self.training_timer_names))
       self.csv_file.flush()
 
-    self.start_time = time.clock()
+    # wall-clock time, time.clock() is CPU time of process in Linux
+    self.start_time = time.time()
+
+    # validation states are sampled once and kept compressed,
+    # they are evaluated in minibatches using the same buffer
+    self.validation_size = args.validation_states
     self.validation_states = None
+    self.validation_batch_size = args.batch_size
+    self.validation_buffer = np.empty((args.batch_size, args.history_length, args.screen_height, args.screen_width), dtype = np.uint8)
 
   def reset(self):
-    self.epoch_start_time = time.clock()
+    self.epoch_start_time = time.time()
     self.num_steps = 0
     self.num_games = 0
-    self.game_rewards = 0
+    # rewards of current game in each environment
+    self.game_rewards = np.zeros(self.num_envs)
     self.average_reward = 0
     self.min_game_reward = sys.maxint
     self.max_game_reward = -sys.maxint - 1
     self.last_exploration_rate = 1
     self.average_cost = 0
+    if self.agent.prefetcher:
+      self.agent.prefetcher.reset()
+    if self.agent.learner:
+      self.agent.learner.reset()
+    for timers in self.timers:
+      timers.reset()
 
   # callback for agent
-  def on_step(self, action, reward, terminal, screen, exploration_rate):
-    self.game_rewards += reward
+  def on_step(self, action, reward, terminal, screen, exploration_rate, env = 0):
+    self.game_rewards[env] += reward
     self.num_steps += 1
     self.last_exploration_rate = exploration_rate
 
     if terminal:
+      game_reward = self.game_rewards[env]
       self.num_games += 1
-      self.average_reward += float(self.game_rewards - self.average_reward) / self.num_games
-      self.min_game_reward = min(self.min_game_reward, self.game_rewards)
-      self.max_game_reward = max(self.max_game_reward, self.game_rewards)
-      self.game_rewards = 0
+      self.average_reward += float(game_reward - self.average_reward) / self.num_games
+      self.min_game_reward = min(self.min_game_reward, game_reward)
+      self.max_game_reward = max(self.max_game_reward, game_reward)
+      self.game_rewards[env] = 0
 
   def on_train(self, cost):
     self.average_cost += (cost - self.average_cost) / self.net.train_iterations
 
   def write(self, epoch, phase):
-    current_time = time.clock()
+    current_time = time.time()
     total_time = current_time - self.start_time
     epoch_time = current_time - self.epoch_start_time
     steps_per_second = self.num_steps / epoch_time
 
     if self.num_games == 0:
       self.num_games = 1
-      self.average_reward = self.game_rewards
+      self.average_reward = np.mean(self.game_rewards)
 
-    if self.validation_states is None and self.mem.count > self.mem.batch_size:
-      # sample states for measuring Q-value dynamics
-      prestates, actions, rewards, poststates, terminals = self.mem.getMinibatch()
-      self.validation_states = prestates
+    # --validation_states 0 turns validation off
+    if self.validation_size and self.validation_states is None and self.mem.valid_count >= min(self.validation_size, self.mem.size // 2):
+      self._sampleValidationStates()
+    meanq, maxq, action_entropy, dominant_action_share, validation_time = self._validate()
+    times = [self.agent.timers.totals[name] for name in self.timer_names]
+    net_times = self.net.timers.totals if hasattr(self.net, 'timers') else {}
+    training_times = [net_times.get(name, 0) for name in self.training_timer_names]
 
     if self.csv_name:
-      if self.validation_states is not None:
-        qvalues = self.net.predict(self.validation_states)
-        maxqs = np.max(qvalues, axis=1)
-        assert maxqs.shape[0] == qvalues.shape[0]
-        meanq = np.mean(maxqs)
-      else:
-        meanq = 0
-
       self.csv_writer.writerow((
           epoch,
           phase,
@@ -110,14 +134,65 @@ class Statistics:
           self.net.train_iterations,
           total_time,
           epoch_time,
-          steps_per_second
-        ))
+          steps_per_second,
+          maxq,
+          action_entropy,
+          dominant_action_share,
+          validation_time
+        ) + tuple(times) + tuple(training_times))
       self.csv_file.flush()
     
     logger.info("  num_games: %d, average_reward: %f, min_game_reward: %d, max_game_reward: %d" % 
         (self.num_games, self.average_reward, self.min_game_reward, self.max_game_reward))
     logger.info("  last_exploration_rate: %f, epoch_time: %ds, steps_per_second: %d" %
         (self.last_exploration_rate, epoch_time, steps_per_second))
+    logger.info("  time: " + ", ".join("%s: %.2fs" % item for item in zip(self.timer_names, times)))
+    logger.info("  training time: " + ", ".join("%s: %.2fs" % item for item in zip(self.training_timer_names, training_times)))
+    if self.validation_states is not None:
+      logger.info("  meanq: %f, maxq: %f, action_entropy: %f, dominant_action_share: %f, validation_time: %fs" %
+          (meanq, maxq, action_entropy, dominant_action_share, validation_time))
+    if self.agent.prefetcher:
+      prefetcher = self.agent.prefetcher
+      logger.info("  prefetch_waits: %d/%d minibatches, prefetch_wait_time: %fs" %
+          (prefetcher.num_waits, prefetcher.num_minibatches, prefetcher.wait_time))
+    if self.agent.learner and self.agent.learner.num_updates:
+      logger.info("  learner_updates: %d, acting_waits: %d" % (self.agent.learner.num_updates, self.agent.learner.num_waits))
+    if isinstance(getattr(self.mem, 'screens', None), CompressedFrameStore):
+      logger.info("  replay_compression_ratio: %f" % self.mem.screens.compressionRatio())
+
+  def _sampleValidationStates(self):
+    # sample states for measuring Q-value dynamics
+    states = self.mem.sampleStates(self.validation_size)
+    self.validation_count, history_length = states.shape[:2]
+    # consecutive frames of a state differ little, so they compress well
+    chunk_size = self.validation_batch_size * history_length
+    self.validation_states = CompressedFrameStore((self.validation_count * history_length,) + states.shape[2:], chunk_size, 1)
+    self.validation_states[:] = states.reshape((-1,) + states.shape[2:])
+    self.validation_indexes = np.arange(self.validation_count * history_length).reshape((self.validation_count, history_length))
+    logger.info("Sampled %d validation states, compression ratio %f" % (self.validation_count, self.validation_states.compressionRatio()))
+
+  def _validate(self):
+    if self.validation_states is None or self.validation_count == 0:
+      return 0, 0, 0, 0, 0
+    start_time = time.time()
+    sum_maxq = 0.
+    maxq = -np.inf
+    action_counts = np.zeros(self.agent.num_actions, dtype = np.int64)
+    for first in xrange(0, self.validation_count, self.validation_batch_size):
+      last = min(first + self.validation_batch_size, self.validation_count)
+      states = self.validation_buffer[:last - first]
+      self.validation_states.take(self.validation_indexes[first:last], out = states)
+      qvalues = self.net.predict(states)
+      maxqs = np.max(qvalues, axis = 1)
+      sum_maxq += maxqs.sum()
+      maxq = max(maxq, maxqs.max())
+      action_counts += np.bincount(np.argmax(qvalues, axis = 1), minlength = self.agent.num_actions)
+    meanq = sum_maxq / self.validation_count
+    # distribution of greedy actions, collapse to one action shows as low entropy
+    probs = action_counts[action_counts > 0] / float(self.validation_count)
+    action_entropy = -np.sum(probs * np.log(probs))
+    dominant_action_share = action_counts.max() / float(self.validation_count)
+    return meanq, maxq, action_entropy, dominant_action_share, time.time() - start_time
 
   def close(self):
     if self.csv_name:
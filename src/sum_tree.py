@@ -0,0 +1,53 @@
+import numpy as np
+
+class SumTree:
+  """
+  Binary tree stored in flat array, where leaves hold priorities and each
+  inner node holds the sum of its children. Node 1 is the root, children
+  of node i are 2i and 2i + 1, leaves start from index capacity.
+  Batch operations walk all paths one tree level at a time, so their cost
+  in Python calls is O(log n) regardless of batch size.
+  """
+  def __init__(self, size):
+    self.depth = max(int(np.ceil(np.log2(size))), 1)
+    self.capacity = 1 << self.depth
+    self.tree = np.zeros(2 * self.capacity, dtype = np.float64)
+
+  def total(self):
+    return self.tree[1]
+
+  def get(self, indexes):
+    return self.tree[np.asarray(indexes) + self.capacity]
+
+  def set(self, index, priority):
+    # single item update, plain scalar ops are faster than array ops here
+    node = index + self.capacity
+    self.tree[node] = priority
+    node >>= 1
+    while node >= 1:
+      self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+      node >>= 1
+
+  def update(self, indexes, priorities):
+    # batch update, later duplicate indexes win
+    nodes = np.asarray(indexes, dtype = np.int64) + self.capacity
+    self.tree[nodes] = priorities
+    # recompute sums instead of adding deltas to avoid accumulating errors,
+    # all nodes stay on the same level, so root is reached at the same time
+    for level in xrange(self.depth):
+      nodes = np.unique(nodes >> 1)
+      self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+  def find(self, values):
+    # find leaves where cumulative sum of priorities exceeds given values,
+    # values must be in range [0, total). Subtrees with zero sum are never
+    # entered, so rounding errors lead to the nearest leaf with priority.
+    values = np.array(values, dtype = np.float64)
+    nodes = np.ones(len(values), dtype = np.int64)
+    for level in xrange(self.depth):
+      nodes *= 2
+      left = self.tree[nodes]
+      right = ((values >= left) & (self.tree[nodes + 1] > 0)) | (left == 0)
+      values -= left * right
+      nodes += right
+    return nodes - self.capacity
@@ -17,11 +17,22 @@ envarg = parser.add_argument_group('Environment')
 envarg.add_argument("env_id", help="Which atari game to test such as Breakout-v0")
 envarg.add_argument("--screen_width", type=int, default=84, help="Screen width after resize.")
 envarg.add_argument("--screen_height", type=int, default=84, help="Screen height after resize.")
+envarg.add_argument("--screen_crop", type=lambda s: tuple(int(x) for x in s.split(',')), help="Pixels to remove from top,bottom,left,right of screen before resize.")
+envarg.add_argument("--screen_interpolation", choices=['nearest', 'linear', 'area', 'cubic'], default='linear', help="Interpolation used for resizing screen.")
 envarg.add_argument("--display", type=str2bool, default=False, help="Display screen during testing.")
 
 memarg = parser.add_argument_group('Replay memory')
 memarg.add_argument("--replay_size", type=int, default=1000000, help="Maximum size of replay memory.")
 memarg.add_argument("--history_length", type=int, default=4, help="How many screen frames form a state.")
+memarg.add_argument("--replay_storage", choices=["memory", "memmap", "compressed"], default="memory", help="Keep replay memory screens in RAM, in memory-mapped file, which allows replay memory larger than RAM, or compressed in RAM.")
+memarg.add_argument("--replay_file", help="File for memory-mapped replay memory screens, temporary file by default.")
+memarg.add_argument("--replay_chunk_size", type=int, default=4, help="How many consecutive screens are compressed together with compressed replay storage.")
+memarg.add_argument("--replay_cache_chunks", type=int, default=256, help="How many decompressed chunks to cache with compressed replay storage.")
+memarg.add_argument("--prioritized_replay", type=str2bool, default=False, help="Sample transitions proportionally to their TD error.")
+memarg.add_argument("--priority_alpha", type=float, default=0.6, help="How much prioritization is used, 0 means uniform sampling.")
+memarg.add_argument("--priority_beta", type=float, default=0.4, help="How much importance sampling weights compensate for prioritization, 1 means full compensation.")
+memarg.add_argument("--n_step", type=int, default=1, help="Train on n-step returns, which replay memory accumulates while transitions are added.")
+memarg.add_argument("--priority_epsilon", type=float, default=1e-6, help="Small constant added to priorities, so that no transition has zero probability.")
 
 netarg = parser.add_argument_group('Deep Q-learning network')
 netarg.add_argument("--learning_rate", type=float, default=0.00025, help="Learning rate.")
@@ -31,9 +42,12 @@ netarg.add_argument('--optimizer', choices=['rmsprop', 'adam', 'adadelta'], defa
 netarg.add_argument("--decay_rate", type=float, default=0.95, help="Decay rate for RMSProp and Adadelta algorithms.")
 netarg.add_argument("--clip_error", type=float, default=1, help="Clip error term in update between this number and its negative.")
 netarg.add_argument("--target_steps", type=int, default=10000, help="Copy main network to target network after this many steps.")
+netarg.add_argument("--target_update_tau", type=float, default=0, help="Move target network towards main network by this fraction after every training step, 0 disables. Use with --target_steps 0 for soft updates only.")
 netarg.add_argument("--min_reward", type=float, default=-1, help="Minimum reward.")
 netarg.add_argument("--max_reward", type=float, default=1, help="Maximum reward.")
 netarg.add_argument("--batch_norm", type=str2bool, default=False, help="Use batch normalization in all layers.")
+netarg.add_argument("--device_history", type=str2bool, default=False, help="Keep frame history for acting in backend memory and upload only the newest frame every step.")
+netarg.add_argument("--inference_batch_size", type=int, default=1, help="Batch size of separate model for predicting actions, which shares weights with training model. 0 uses training model.")
 
 neonarg = parser.add_argument_group('Neon')
 neonarg.add_argument('--backend', choices=['cpu', 'gpu'], default='gpu', help='backend type')
@@ -48,6 +62,11 @@ antarg.add_argument("--exploration_decay_steps", type=float, default=1000000, he
 antarg.add_argument("--exploration_rate_test", type=float, default=0.05, help="Exploration rate used during testing.")
 antarg.add_argument("--train_frequency", type=int, default=4, help="Perform training after this many game steps.")
 antarg.add_argument("--train_repeat", type=int, default=1, help="Number of times to sample minibatch during training.")
+antarg.add_argument("--prefetch_minibatches", type=int, default=0, help="Prepare this many minibatches in background thread while network is trained, 0 disables prefetching.")
+antarg.add_argument("--learner_thread", type=str2bool, default=False, help="Train network in background thread while acting.")
+antarg.add_argument("--replay_ratio", type=float, default=0, help="Minibatch updates per environment step with learner thread, 0 means train_repeat / train_frequency.")
+antarg.add_argument("--learner_max_lag", type=int, default=100, help="Acting waits when learner thread is this many minibatch updates behind.")
+antarg.add_argument("--acting_sync_updates", type=int, default=100, help="Copy weights used for acting after this many minibatch updates in learner thread.")
 antarg.add_argument("--random_starts", type=int, default=30, help="Perform max this number of dummy actions after game restart, to produce more random game dynamics.")
 
 mainarg = parser.add_argument_group('Main loop')
@@ -67,6 +86,7 @@ args = parser.parse_args()
 
 if args.random_seed:
   random.seed(args.random_seed)
+  np.random.seed(args.random_seed)
 
 env = GymEnvironment(args.env_id, args)
 net = DeepQNetwork(env.numActions(), args)
@@ -0,0 +1,20 @@
+import time
+
+class Timers:
+  """
+  Accumulates wall-clock time spent in each phase. Phases are timed by
+  passing the end time of previous phase as start of the next one, so that
+  timing a phase costs one time.time() call and can be left always on.
+  """
+  def __init__(self, names):
+    self.names = names
+    self.reset()
+
+  def reset(self):
+    self.totals = dict((name, 0.) for name in self.names)
+
+  def add(self, name, start):
+    # adds time since start to phase and returns current time
+    now = time.time()
+    self.totals[name] += now - start
+    return now